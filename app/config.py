@@ -1,5 +1,5 @@
 from pydantic_settings import BaseSettings
-from typing import Optional, List
+from typing import Optional, List, Dict
 
 class Settings(BaseSettings):
     # OpenAI & Gemini Configuration
@@ -8,21 +8,65 @@ class Settings(BaseSettings):
     AZURE_OPENAI_ENDPOINT: str = "https://agrostandai-openai-instance.openai.azure.com/"
     AZURE_OPENAI_API_VERSION: str = "2024-12-01-preview"
     AZURE_OPENAI_DEPLOYMENT_NAME: str = "gpt-4o"
+    AZURE_OPENAI_SUMMARY_DEPLOYMENT_NAME: str = "gpt-4o-mini"  # cheaper model for rolling summaries
+    OPENAI_MAX_CONNECTIONS: int = 500  # shared async pool across all LLM calls
+    OPENAI_MAX_KEEPALIVE_CONNECTIONS: int = 100
+    OPENAI_TIMEOUT: float = 60.0  # seconds per completion request
     
     # Twilio Configuration
     TWILIO_ACCOUNT_SID: Optional[str] = None
     TWILIO_AUTH_TOKEN: Optional[str] = None
     TWILIO_PHONE_NUMBER: Optional[str] = None  # WhatsApp number (e.g., 'whatsapp:+14155238886')
+    TWILIO_MAX_CONNECTIONS: int = 50  # keep-alive pool for outbound sends
+    TWILIO_MAX_CONCURRENT_SENDS: int = 20  # stay under Twilio's per-account concurrency limit
+    TWILIO_TIMEOUT: float = 15.0
     
     # MongoDB Configuration
     MONGO_URI: Optional[str] = None
     DATABASE_NAME: str = "crop_disease_bot"
+    MONGO_MAX_POOL_SIZE: int = 100
+    MONGO_MIN_POOL_SIZE: int = 0
+    MONGO_CONNECT_TIMEOUT_MS: int = 5000
+    MONGO_SERVER_SELECTION_TIMEOUT_MS: int = 5000
+    MONGO_SOCKET_TIMEOUT_MS: int = 10000
+    MESSAGE_FLUSH_BATCH_SIZE: int = 100  # write-behind: flush at this many buffered messages...
+    MESSAGE_FLUSH_INTERVAL_SECONDS: float = 0.5  # ...or this long after the first one
+    MESSAGE_BUFFER_MAX_SIZE: int = 5000  # save_message waits when this many are pending
+    MESSAGE_FLUSH_MAX_RETRIES: int = 5  # failed flushes are retried with backoff, then dropped
+    MESSAGE_FLUSH_RETRY_BASE_DELAY_SECONDS: float = 0.5
+    USER_CACHE_MAX_SIZE: int = 10000  # user records cached in memory (LRU)
+    USER_CACHE_TTL_SECONDS: float = 600.0
+    IMAGE_STORE_BACKEND: str = "gridfs"  # "gridfs" or "local" (content-addressed by SHA-256)
+    IMAGE_STORE_PATH: str = "image_store"  # root directory for the local backend
+    IMAGE_MAX_EDGE: int = 1568  # longest side sent to the vision model, in pixels
+    IMAGE_JPEG_QUALITY: int = 85
+    IMAGE_PREPROCESS_WORKERS: int = 2  # processes for decode/resize/encode (0 = thread)
+    DIAGNOSIS_CACHE_MAX_SIZE: int = 2048  # photos remembered for near-duplicate reuse
+    DIAGNOSIS_CACHE_TTL_SECONDS: float = 3600.0
+    DIAGNOSIS_CACHE_MAX_DISTANCE: int = 6  # max differing dHash bits (of 64) to count as the same photo
+    TREATMENT_CACHE_MAX_SIZE: int = 1000  # shared (disease, crop) treatment answers
+    TREATMENT_CACHE_TTL_SECONDS: float = 86400.0
     
     # Bot Configuration
     MAX_MESSAGE_LENGTH: int = 1500
-    MAX_CONVERSATION_HISTORY: int = 10
+    WHATSAPP_STREAMING_REPLIES: bool = True  # send reply chunks while the model is still writing
+    STREAM_CHUNK_MIN_LENGTH: int = 400  # smallest chunk released at a paragraph break
+    MAX_CONVERSATION_HISTORY: int = 30  # messages kept per session
+    SESSION_SHARDS: int = 16  # lock stripes in the session map
+    SESSION_TIMEOUT_SECONDS: int = 3600
+    SESSION_STORE_BACKEND: str = "memory"  # "memory" (single worker) or "mongo" (shared across workers)
+    SESSION_STORE_MAX_SESSIONS: int = 50000  # memory backend only
+    SESSION_MEMORY_BUDGET_BYTES: int = 256 * 1024 * 1024  # estimated bytes across all local sessions
+    SESSION_MEMORY_LOW_WATER: float = 0.9  # evict least recently active sessions down to this fraction
+    SESSION_SNAPSHOT_PATH: str = "session_snapshot.jsonl.gz"  # each worker writes <path>.<pid>; empty disables warm restarts
+    SESSION_SNAPSHOT_INTERVAL_SECONDS: float = 300.0  # 0 = only on shutdown
     DEFAULT_TEMPERATURE: float = 0.3
-    MAX_TOKENS: int = 1200
+    MAX_TOKENS: int = 6000  # history tokens kept per session; also the budget for unlisted call types
+    CONTEXT_TOKEN_BUDGETS: Dict[str, int] = {"chat": 4000, "image": 2000}  # history tokens sent per call
+    IMAGE_TOKEN_ESTIMATE: int = 765  # prompt cost of one attached photo (gpt-4o high detail)
+    SUMMARY_TRIGGER_TOKENS: int = 2500  # fold older turns into the summary past this many history tokens
+    SUMMARY_KEEP_RECENT_MESSAGES: int = 6  # latest messages always kept verbatim
+    SUMMARY_MAX_TOKENS: int = 300
     
     # Indian Agriculture Specific Settings
     SUPPORTED_LANGUAGES: List[str] = ["hindi", "english", "hinglish"]
@@ -42,6 +86,20 @@ class Settings(BaseSettings):
     REQUESTS_PER_MINUTE: int = 60
     REQUESTS_PER_HOUR: int = 1000
 
+    # Webhook Processing
+    WEBHOOK_WORKER_CONCURRENCY: int = 32  # messages processed in parallel per app worker
+    WEBHOOK_SHUTDOWN_GRACE_SECONDS: float = 25.0
+    WEBHOOK_DEDUPE_WINDOW_SIZE: int = 10000  # recent MessageSids remembered in memory
+
+    # Durable Job Queue
+    JOB_QUEUE_BACKEND: str = "auto"  # "mongo", "sqlite" or "auto" (mongo when MONGO_URI is set)
+    JOB_QUEUE_SQLITE_PATH: str = "jobs.db"
+    JOB_VISIBILITY_TIMEOUT_SECONDS: float = 180.0  # unfinished jobs become claimable again after this
+    JOB_HEARTBEAT_INTERVAL_SECONDS: float = 30.0  # running jobs extend their lease this often
+    JOB_MAX_ATTEMPTS: int = 3  # then the job is dead-lettered
+    JOB_RETRY_BASE_DELAY_SECONDS: float = 5.0
+    JOB_POLL_INTERVAL_SECONDS: float = 1.0
+
     class Config:
         env_file = ".env"
         env_file_encoding = "utf-8"
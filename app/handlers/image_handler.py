@@ -0,0 +1,155 @@
+import asyncio
+import base64
+from app.services.mongo_db import save_user, save_message
+from app.services.gemini_api import analyze_crop_image
+from app.services.image_store import image_store, image_ref
+from app.services.whatsapp_api import WhatsAppReplyStream, send_whatsapp_message, send_whatsapp_messages
+from app.utils.helper import TransientError, format_whatsapp_message, download_twilio_media
+from app.config import settings
+from app.models import InboundWhatsAppMessage
+
+ACK_MESSAGE = "📸 Photo mil gayi! Analysis ho raha hai...\n(Image received! Analyzing...)"
+
+FOLLOW_UP_MESSAGE = (
+    "\n💬 Aur jaankari ke liye puchiye:\n"
+    "• 'treatment' - detailed ilaj\n"
+    "• 'prevention' - future bachav\n"
+    "• 'medicine' - dawa ki jaankari\n\n"
+    "Ask for more info:\n"
+    "• 'उपचार' or 'treatment'\n"
+    "• 'रोकथाम' or 'prevention'\n"
+    "• 'दवा' or 'medicine'"
+)
+
+async def _store_image(image_content: bytes) -> dict:
+    """Store the photo by content hash; if the store is down, still return its ref"""
+    try:
+        return await image_store.put(image_content)
+    except Exception as e:
+        # The message log keeps the ref either way, so the turn is not lost
+        print(f"Image store error: {str(e)}")
+        return image_ref(image_content)
+
+async def handle_image_message(inbound: InboundWhatsAppMessage, send_ack: bool = True):
+    """Download, analyze and reply to a crop photo sent over WhatsApp"""
+    user_id = inbound.user_id
+    phone_number = inbound.phone_number
+    media_url = inbound.media_url or ""
+
+    try:
+        # Save user with phone number
+        await save_user(user_id, phone_number, "")
+
+        # Send acknowledgment (once per photo, not again on retries)
+        if send_ack:
+            await send_whatsapp_message(phone_number, ACK_MESSAGE)
+
+            # Save acknowledgment message to database
+            await save_message(
+                user_id=user_id,
+                message=ACK_MESSAGE,
+                is_bot=True,
+                crop_type="",
+                is_template=True
+            )
+
+        # Download image off the event loop so other workers keep running
+        try:
+            image_content = await asyncio.to_thread(download_twilio_media, media_url)
+            print(f"Successfully downloaded image for {phone_number}, size: {len(image_content)} bytes")
+        except Exception as download_error:
+            print(f"Image download error for {phone_number}: {str(download_error)}")
+            raise download_error
+
+        # Convert to base64
+        image_base64 = base64.b64encode(image_content).decode('utf-8')
+        print(f"Image converted to base64 for {phone_number}, length: {len(image_base64)}")
+
+        # Stream the report: sections go out while the model is still writing
+        reply_stream = (
+            WhatsAppReplyStream(phone_number, first_prefix="📋 Fasal Analysis Report:\n")
+            if settings.WHATSAPP_STREAMING_REPLIES else None
+        )
+
+        # Store the photo once by content hash while the model looks at it;
+        # the message only keeps the ref
+        store_task = asyncio.create_task(_store_image(image_content))
+
+        # Analyze image with context and session management
+        diagnosis, crop_type = await analyze_crop_image(image_base64, user_id, reply_stream=reply_stream)
+
+        await save_message(
+            user_id=user_id,
+            message="",  # Empty message for image uploads
+            image=await store_task,
+            is_bot=False,
+            crop_type=crop_type
+        )
+
+        # Record whatever the farmer has already received
+        for chunk in reply_stream.sent if reply_stream else []:
+            await save_message(
+                user_id=user_id,
+                message=chunk,
+                is_bot=True,
+                crop_type=crop_type
+            )
+
+        outgoing = []
+        if reply_stream and reply_stream.completed:
+            # Chunks held back after a failed streaming send go out with the rest
+            for chunk in reply_stream.unsent:
+                await save_message(
+                    user_id=user_id,
+                    message=chunk,
+                    is_bot=True,
+                    crop_type=crop_type
+                )
+            outgoing.extend(reply_stream.unsent_messages())
+        else:
+            # Not streamed (cached, shared or failed mid-stream): format diagnosis in proper chunks
+            diagnosis_chunks = format_whatsapp_message(diagnosis, max_length=1500)
+
+            for i, chunk in enumerate(diagnosis_chunks):
+                # Save each diagnosis chunk to database
+                await save_message(
+                    user_id=user_id,
+                    message=chunk,
+                    is_bot=True,
+                    crop_type=crop_type
+                )
+
+                if len(diagnosis_chunks) > 1:
+                    outgoing.append(f"📋 Report ({i+1}/{len(diagnosis_chunks)})\n{chunk}")
+                else:
+                    outgoing.append(f"📋 Fasal Analysis Report:\n{chunk}")
+
+        # Send report chunks and follow-up options back-to-back
+        outgoing.append(FOLLOW_UP_MESSAGE)
+        await send_whatsapp_messages(phone_number, outgoing)
+
+        # Save follow-up message to database
+        await save_message(
+            user_id=user_id,
+            message=FOLLOW_UP_MESSAGE,
+            is_bot=True,
+            crop_type=crop_type,
+            is_template=True
+        )
+
+    except TransientError:
+        # Download or model hiccup: the job queue retries with backoff
+        raise
+    except Exception as e:
+        error_msg = f"❌ Photo processing mein problem: {str(e)[:100]}..."
+        print(f"Image processing error for {phone_number}: {str(e)}")
+        await send_whatsapp_message(phone_number, error_msg)
+
+        # Save error message to database
+        await save_message(
+            user_id=user_id,
+            message=error_msg,
+            is_bot=True,
+            crop_type="",
+            is_template=True
+        )
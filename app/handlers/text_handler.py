@@ -0,0 +1,125 @@
+from app.services.mongo_db import save_user, save_message
+from app.services.gemini_api import chat_with_gpt, get_user_session_info
+from app.services.whatsapp_api import WhatsAppReplyStream, send_whatsapp_message, send_whatsapp_messages
+from app.utils.helper import TransientError, format_whatsapp_message
+from app.config import settings
+from app.models import InboundWhatsAppMessage
+
+HELP_MESSAGE = (
+    "🌾 *Krishi Sahayak Bot*\n\n"
+    "Main aapki fasal ki problem mein madad kar sakta hun:\n"
+    "📸 Fasal ki photo bhejiye\n"
+    "💬 Apni problem likhiye\n"
+    "📍 Apna location bataiye\n\n"
+    "*Agri Help Bot*\n"
+    "I can help with crop problems:\n"
+    "📸 Send crop photos\n"
+    "💬 Describe your problem\n"
+    "📍 Share your location"
+)
+
+async def handle_text_message(inbound: InboundWhatsAppMessage):
+    """Process a text WhatsApp message and reply through the outbound API"""
+    user_id = inbound.user_id
+    phone_number = inbound.phone_number
+    message = inbound.message
+
+    try:
+        # Save user with phone number
+        await save_user(user_id, phone_number, "")
+
+        # Stream the reply: chunks go out while the model is still writing
+        reply_stream = WhatsAppReplyStream(phone_number) if settings.WHATSAPP_STREAMING_REPLIES else None
+
+        # Get AI response with crop type (includes session management)
+        reply, crop_type = await chat_with_gpt(message, user_id, reply_stream)
+
+        # Save user message to database
+        await save_message(
+            user_id=user_id,
+            message=message,
+            is_bot=False,
+            crop_type=crop_type
+        )
+
+        # Record whatever the farmer has already received
+        for chunk in reply_stream.sent if reply_stream else []:
+            await save_message(
+                user_id=user_id,
+                message=chunk,
+                is_bot=True,
+                crop_type=crop_type
+            )
+
+        outgoing = []
+        if reply_stream and reply_stream.completed:
+            # Chunks held back after a failed streaming send go out with the rest
+            for chunk in reply_stream.unsent:
+                await save_message(
+                    user_id=user_id,
+                    message=chunk,
+                    is_bot=True,
+                    crop_type=crop_type
+                )
+            outgoing.extend(reply_stream.unsent_messages())
+        else:
+            # Not streamed (or failed mid-stream): format response in properly sized chunks
+            message_chunks = format_whatsapp_message(reply, max_length=1500)
+
+            for i, chunk in enumerate(message_chunks):
+                # Save each bot reply chunk to database
+                await save_message(
+                    user_id=user_id,
+                    message=chunk,
+                    is_bot=True,
+                    crop_type=crop_type
+                )
+
+                # Add message number indicator for multi-part messages
+                if len(message_chunks) > 1:
+                    outgoing.append(f"({i+1}/{len(message_chunks)})\n{chunk}")
+                else:
+                    outgoing.append(chunk)
+
+        # Send session info to user if it's a long conversation
+        session_info = get_user_session_info(user_id)
+        if session_info and session_info.get("message_count", 0) > 20:
+            outgoing.append(f"💬 Session: {session_info.get('message_count', 0)} messages, {session_info.get('time_remaining', 0)//60:.0f} min remaining")
+
+        # Deliver all parts back-to-back, in order
+        if outgoing:
+            await send_whatsapp_messages(phone_number, outgoing)
+
+    except TransientError:
+        # Model hiccup before anything was sent: the job queue retries with backoff
+        raise
+    except Exception as e:
+        error_msg = f"❌ Message processing mein problem: {str(e)[:100]}..."
+        print(f"Text processing error for {phone_number}: {str(e)}")
+        await send_whatsapp_message(phone_number, error_msg)
+
+        # Save error message to database
+        await save_message(
+            user_id=user_id,
+            message=error_msg,
+            is_bot=True,
+            crop_type="",
+            is_template=True
+        )
+
+async def handle_help_message(inbound: InboundWhatsAppMessage):
+    """Reply with usage help when the message has neither text nor image"""
+    user_id = inbound.user_id
+    phone_number = inbound.phone_number
+
+    await send_whatsapp_message(phone_number, HELP_MESSAGE)
+
+    # Save help message to database
+    await save_user(user_id, phone_number, "")
+    await save_message(
+        user_id=user_id,
+        message=HELP_MESSAGE,
+        is_bot=True,
+        crop_type="",
+        is_template=True
+    )
@@ -1,10 +1,41 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from app.routes import main_router
+from app.services.gemini_api import close_llm_client
+from app.services.whatsapp_api import close_whatsapp_client
+from app.services.mongo_db import close_mongo_client, ensure_indexes, message_buffer
+from app.services.image_store import image_store
+from app.services.image_preprocessing import start_preprocessing_pool, stop_preprocessing_pool
+from app.services.webhook_queue import start_webhook_workers, stop_webhook_workers
+from app.services.session_manager import restore_session_snapshot, start_session_cleanup, stop_session_cleanup
+from app.services.session_store import session_store
+from app.utils.tokens import load_tokenizer
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await ensure_indexes()
+    await image_store.setup()
+    await session_store.setup()
+    start_preprocessing_pool()
+    message_buffer.start()
+    await load_tokenizer()
+    await restore_session_snapshot()
+    start_session_cleanup()
+    await start_webhook_workers()
+    yield
+    # Drain in-flight webhook work, then release pooled connections
+    await stop_webhook_workers()
+    await stop_session_cleanup()
+    stop_preprocessing_pool()
+    await close_llm_client()
+    await close_whatsapp_client()
+    await close_mongo_client()
 
 app = FastAPI(
     title="WhatsApp AI Bot",
     description="FastAPI app to chat and detect crop diseases",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # Health check endpoint for Render
@@ -27,9 +27,13 @@ class MessageSchema(BaseModel):
     user_id: str
     phone_number: Optional[str] = ""
     message: Optional[str] = ""
-    image_base64: Optional[str] = ""
+    # Images live in the content-addressed image store; only the ref is kept here
+    image_sha256: Optional[str] = None
+    image_size: Optional[int] = None
+    image_mime_type: Optional[str] = None
     crop_type: Optional[str] = ""
     is_bot: bool = False
+    is_template: bool = False  # fixed bot text (ack, menu, help, error) - not conversation context
     timestamp: datetime = Field(default_factory=datetime.now)
 
 class UserSchema(BaseModel):
@@ -38,3 +42,12 @@ class UserSchema(BaseModel):
     name: Optional[str] = ""
     created_at: datetime = Field(default_factory=datetime.now)
     updated_at: datetime = Field(default_factory=datetime.now)
+
+class InboundWhatsAppMessage(BaseModel):
+    """Inbound Twilio webhook payload queued for background processing"""
+    user_id: str
+    phone_number: str
+    message: str = ""
+    media_url: Optional[str] = None
+    message_sid: Optional[str] = None  # Twilio MessageSid, used for retry dedupe
+    received_at: datetime = Field(default_factory=datetime.now)
@@ -1,6 +1,9 @@
 from fastapi import APIRouter
 from app.config import settings
-from app.services.gemini_api import get_active_sessions_count, get_all_sessions_info
+from app.services.gemini_api import get_active_sessions_count, get_all_sessions_info, treatment_cache, llm_singleflight
+from app.services.webhook_queue import get_queue_stats
+from app.services.mongo_db import message_buffer, user_cache
+from app.services.diagnosis_cache import diagnosis_cache
 import os
 
 router = APIRouter()
@@ -36,4 +39,26 @@ async def debug_sessions():
         "session_manager_status": "active",
         "active_sessions": get_active_sessions_count(),
         "all_sessions": get_all_sessions_info()
+    }
+
+@router.get("/debug/queue")
+async def debug_queue():
+    """Debug endpoint to check durable webhook job queue"""
+    return await get_queue_stats()
+
+@router.get("/debug/db")
+async def debug_db():
+    """Debug endpoint to check buffered Mongo writes and the user cache"""
+    return {
+        "message_buffer": message_buffer.get_stats(),
+        "user_cache": user_cache.get_stats()
+    }
+
+@router.get("/debug/cache")
+async def debug_cache():
+    """Debug endpoint to check LLM response cache hit rates"""
+    return {
+        "diagnosis_cache": diagnosis_cache.get_stats(),
+        "treatment_cache": treatment_cache.get_stats(),
+        "llm_singleflight": llm_singleflight.get_stats()
     }
\ No newline at end of file
@@ -1,7 +1,9 @@
 from fastapi import APIRouter, HTTPException
 from app.services.mongo_db import save_user, save_message
+from app.services.image_store import image_store
 from app.services.gemini_api import analyze_crop_image, get_user_session_info
 from app.models import ImageRequest
+import base64
 
 router = APIRouter()
 
@@ -14,7 +16,7 @@ async def handle_image_upload(payload: ImageRequest):
             raise HTTPException(status_code=400, detail="user_id and base64_image are required")
 
         # Save user (only once)
-        save_user(payload.user_id, "", payload.user_name or "")
+        await save_user(payload.user_id, "", payload.user_name or "")
 
         # Enhanced image analysis with session management
         diagnosis, crop_type = await analyze_crop_image(
@@ -22,17 +24,18 @@ async def handle_image_upload(payload: ImageRequest):
             payload.user_id  # Now includes session management
         )
 
-        # Save image upload to database (store base64 instead of message)
-        save_message(
+        # Store the photo once by content hash; the message only keeps the ref
+        image_ref = await image_store.put(base64.b64decode(payload.base64_image))
+        await save_message(
             user_id=payload.user_id,
             message="",  # Empty message for image
-            image_base64=payload.base64_image,
+            image=image_ref,
             is_bot=False,
             crop_type=crop_type
         )
 
         # Save diagnosis to database
-        save_message(
+        await save_message(
             user_id=payload.user_id,
             message=diagnosis,
             is_bot=True,
@@ -54,11 +57,12 @@ async def handle_image_upload(payload: ImageRequest):
 
     except Exception as e:
         error_msg = f"⚠️ Image analysis mein problem: {str(e)}"
-        save_message(
+        await save_message(
             user_id=payload.user_id,
             message=error_msg,
             is_bot=True,
-            crop_type=""
+            crop_type="",
+            is_template=True
         )
         return {
             "user_id": payload.user_id,
@@ -3,7 +3,8 @@ from app.services.gemini_api import (
     get_user_session_info,
     clear_user_conversation,
     get_active_sessions_count,
-    get_all_sessions_info
+    get_all_sessions_info,
+    get_session_memory_stats
 )
 
 router = APIRouter()
@@ -27,7 +28,7 @@ async def get_session_info(user_id: str):
 @router.delete("/session/{user_id}")
 async def clear_session(user_id: str):
     """Clear a user's session"""
-    success = clear_user_conversation(user_id)
+    success = await clear_user_conversation(user_id)
     return {
         "user_id": user_id,
         "cleared": success,
@@ -40,5 +41,6 @@ async def get_sessions_stats():
     stats = get_all_sessions_info()
     return {
         "active_sessions": get_active_sessions_count(),
+        "memory": get_session_memory_stats(),
         "stats": stats
     }
\ No newline at end of file
@@ -10,16 +10,16 @@ async def get_treatment_details(req: TreatmentRequest):
     """Get detailed treatment information with session context"""
     try:
         # Get detailed treatment guidance with session context
-        treatment_details = get_treatment_followup(req.disease, req.crop, req.user_id)
+        treatment_details = await get_treatment_followup(req.disease, req.crop, req.user_id)
         
         # Save interaction to database
-        save_message(
+        await save_message(
             user_id=req.user_id,
             message=f"Treatment request: {req.disease} in {req.crop}",
             is_bot=False,
             crop_type=req.crop
         )
-        save_message(
+        await save_message(
             user_id=req.user_id,
             message=treatment_details,
             is_bot=True,
@@ -42,11 +42,12 @@ async def get_treatment_details(req: TreatmentRequest):
         
     except Exception as e:
         error_msg = f"Treatment info mein problem: {str(e)}"
-        save_message(
+        await save_message(
             user_id=req.user_id,
             message=error_msg,
             is_bot=True,
-            crop_type=req.crop
+            crop_type=req.crop,
+            is_template=True
         )
         return {
             "user_id": req.user_id,
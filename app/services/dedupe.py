@@ -0,0 +1,50 @@
+import threading
+from collections import OrderedDict
+from app.config import settings
+
+class MessageDeduplicator:
+    """Bounded in-memory window of recently seen Twilio MessageSids.
+
+    This is the fast path for Twilio webhook retries; the durable check is the
+    unique job id (the MessageSid) in the job store, which also catches retries
+    that land on another worker or arrive after a restart.
+    """
+
+    def __init__(self, window_size: int = 10000):
+        self.window_size = window_size
+        self._seen: "OrderedDict[str, None]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.duplicates = 0
+
+    def is_duplicate(self, message_sid: str) -> bool:
+        """Check the window (counts as a duplicate hit when found)"""
+        with self._lock:
+            if message_sid in self._seen:
+                self._seen.move_to_end(message_sid)
+                self.duplicates += 1
+                return True
+            return False
+
+    def mark_seen(self, message_sid: str):
+        """Remember a MessageSid, evicting the oldest beyond the window size"""
+        with self._lock:
+            self._seen[message_sid] = None
+            self._seen.move_to_end(message_sid)
+            while len(self._seen) > self.window_size:
+                self._seen.popitem(last=False)
+
+    def record_duplicate(self):
+        """Count a duplicate caught by the durable store"""
+        with self._lock:
+            self.duplicates += 1
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "window_entries": len(self._seen),
+                "window_size": self.window_size,
+                "duplicates_dropped": self.duplicates,
+            }
+
+# Global deduplicator instance
+message_deduplicator = MessageDeduplicator(window_size=settings.WEBHOOK_DEDUPE_WINDOW_SIZE)
@@ -0,0 +1,91 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+from app.config import settings
+
+class DiagnosisCache:
+    """LRU+TTL cache of image diagnoses keyed by perceptual hash.
+
+    A lookup matches any cached photo whose 64-bit dHash is within
+    ``max_distance`` bits (Hamming distance), so resent and near-identical
+    photos reuse the earlier diagnosis instead of a new vision call.
+
+    Diagnoses made from the photo alone are shared by everyone (``user_id``
+    None). One that drew on a farmer's conversation is stored under their
+    ``user_id`` and only matches their own photos.
+    """
+
+    def __init__(self, max_size: int = 2048, ttl: float = 3600.0, max_distance: int = 6):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_distance = max_distance
+        # (user_id or None, phash) -> (expires_at, diagnosis, crop_type)
+        self._entries: "OrderedDict[Tuple[Optional[str], int], Tuple[float, str, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, phash: int, user_id: Optional[str] = None) -> Optional[Tuple[str, str]]:
+        """Return (diagnosis, crop_type) of the closest unexpired shared or user_id match"""
+        now = time.monotonic()
+        with self._lock:
+            best_key, best_distance = None, self.max_distance + 1
+            expired = []
+            for key, (expires_at, _, _) in self._entries.items():
+                if expires_at <= now:
+                    expired.append(key)
+                    continue
+                scope, key_phash = key
+                if scope is not None and scope != user_id:
+                    continue
+                distance = (key_phash ^ phash).bit_count()
+                if distance < best_distance:
+                    best_key, best_distance = key, distance
+                    if distance == 0:
+                        break
+            for key in expired:
+                del self._entries[key]
+
+            if best_key is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_key)
+            self.hits += 1
+            if best_distance > 0:
+                self.near_hits += 1
+            _, diagnosis, crop_type = self._entries[best_key]
+            return diagnosis, crop_type
+
+    def put(self, phash: int, diagnosis: str, crop_type: str, user_id: Optional[str] = None):
+        key = (user_id, phash)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, diagnosis, crop_type)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl,
+                "max_distance": self.max_distance,
+                "hits": self.hits,
+                "near_duplicate_hits": self.near_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+# Global diagnosis cache instance
+diagnosis_cache = DiagnosisCache(
+    max_size=settings.DIAGNOSIS_CACHE_MAX_SIZE,
+    ttl=settings.DIAGNOSIS_CACHE_TTL_SECONDS,
+    max_distance=settings.DIAGNOSIS_CACHE_MAX_DISTANCE,
+)
@@ -5,21 +5,146 @@ from app.services.session_manager import (
     session_manager,
 )
 
-from typing import List, Tuple, Dict, Optional
-from app.services.mongo_db import extract_crop_type_from_text
-
-from openai import AzureOpenAI
+from typing import List, Set, Tuple, Dict, Optional, cast
+import asyncio
+import base64
+import hashlib
+from app.services.mongo_db import extract_crop_type_from_text, normalize_crop_name
+from app.services.image_preprocessing import preprocess_image
+from app.services.diagnosis_cache import diagnosis_cache
+from app.utils.cache import TTLCache
+from app.utils.singleflight import SingleFlight
+from app.utils.helper import TransientError, WhatsAppStreamChunker
+from app.services.whatsapp_api import WhatsAppReplyStream
+
+import httpx
+from openai import APIConnectionError, AsyncAzureOpenAI, InternalServerError, RateLimitError
 
 # Import settings (assuming settings.py is in app/config or similar)
 from app.config import settings  # Adjust the import path as needed
 
+# Shared HTTP transport - one keep-alive pool for every completion call so a
+# single worker can keep many LLM requests in flight without blocking the loop
+http_client = httpx.AsyncClient(
+    limits=httpx.Limits(
+        max_connections=settings.OPENAI_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+    ),
+    timeout=httpx.Timeout(settings.OPENAI_TIMEOUT, connect=10.0),
+)
+
 # Azure OpenAI client setup
-client = AzureOpenAI(
-    api_version="2024-12-01-preview",
-    azure_endpoint="https://agrostandai-openai-instance.openai.azure.com/",
-    api_key=settings.OPENAI_API_KEY
+client = AsyncAzureOpenAI(
+    api_version=settings.AZURE_OPENAI_API_VERSION,
+    azure_endpoint=settings.AZURE_OPENAI_ENDPOINT,
+    api_key=settings.OPENAI_API_KEY,
+    http_client=http_client,
 )
 
+# Failures worth retrying from the job queue instead of replying with an error
+# (APITimeoutError is an APIConnectionError)
+RETRYABLE_LLM_ERRORS = (APIConnectionError, RateLimitError, InternalServerError)
+
+def is_retryable_failure(e: Exception, reply_stream: Optional[WhatsAppReplyStream]) -> bool:
+    """Transient LLM error before any part of the reply reached the farmer"""
+    return isinstance(e, RETRYABLE_LLM_ERRORS) and not (reply_stream and reply_stream.sent)
+
+# Treatment advice is nearly identical for every farmer, so it is shared
+# across users keyed on the normalized (disease, crop) pair
+treatment_cache = TTLCache(max_size=settings.TREATMENT_CACHE_MAX_SIZE, ttl=settings.TREATMENT_CACHE_TTL_SECONDS)
+
+# Concurrent identical cacheable requests (same treatment key, same photo)
+# share one in-flight completion - protects the Azure TPM quota during spikes
+llm_singleflight = SingleFlight()
+
+def treatment_cache_key(disease: str, crop: str) -> Tuple[str, str]:
+    """Normalize disease casing/whitespace and crop spelling (Hindi/English aliases)"""
+    return " ".join(disease.lower().split()), normalize_crop_name(crop)
+
+# Rolling summaries run in the background; keep references so tasks aren't GC'd
+_summary_tasks: Set[asyncio.Task] = set()
+
+SUMMARY_SYSTEM_PROMPT = """You maintain a running summary of a WhatsApp conversation between an Indian farmer and Dr. AgriBot, a crop disease assistant.
+Merge the new messages into the existing summary. Keep: crops and varieties, location/season, symptoms reported, diagnoses given, treatments and doses recommended, and open questions.
+Drop greetings and repetition. Write in the farmer's language (Hindi/Hinglish/English), as short bullet points, under 150 words."""
+
+async def _summarize_session(user_id: str):
+    """Fold the older turns of a long session into its running summary"""
+    session = session_manager.get_session(user_id)
+    if session is None:
+        return
+    try:
+        folded = session.messages_to_fold(settings.SUMMARY_KEEP_RECENT_MESSAGES)
+        if not folded:
+            return
+        transcript = "\n".join(
+            f"{msg.message_type.value}: {msg.content}{' [photo]' if msg.image_ref or msg.image_base64 else ''}"
+            for msg in folded
+        )
+        previous = session.summary or "(none)"
+        response = await client.chat.completions.create(
+            model=settings.AZURE_OPENAI_SUMMARY_DEPLOYMENT_NAME,
+            messages=[
+                {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+                {"role": "user", "content": f"EXISTING SUMMARY:\n{previous}\n\nNEW MESSAGES:\n{transcript}"},
+            ],
+            temperature=0.2,
+            max_tokens=settings.SUMMARY_MAX_TOKENS,
+        )
+        content = response.choices[0].message.content
+        summary = content.strip() if content else ""
+        if summary:
+            # Removes exactly the folded messages - turns added meanwhile are kept
+            await session_manager.store_summary(user_id, summary, folded)
+            print(f"[SUMMARY] Folded {len(folded)} messages for user {user_id} ({session.summary_tokens} tokens)")
+    except Exception as e:
+        print(f"[SUMMARY] Could not summarize session for user {user_id}: {e}")
+    finally:
+        session.summary_in_progress = False
+
+def schedule_session_summary(user_id: str):
+    """Start a background summary when the session has outgrown the threshold"""
+    session = session_manager.get_session(user_id)
+    if session is None or not session.needs_summary(
+        settings.SUMMARY_TRIGGER_TOKENS, settings.SUMMARY_KEEP_RECENT_MESSAGES
+    ):
+        return
+    session.summary_in_progress = True
+    task = asyncio.create_task(_summarize_session(user_id))
+    _summary_tasks.add(task)
+    task.add_done_callback(_summary_tasks.discard)
+
+async def finish_session_turn(user_id: str):
+    """Publish the turn to the shared session store, then summarize if due"""
+    await session_manager.flush_session(user_id)
+    schedule_session_summary(user_id)
+
+async def _stream_completion(reply_stream: WhatsAppReplyStream, **params) -> str:
+    """Stream a completion, sending each WhatsApp-sized chunk as soon as it is complete"""
+    chunker = WhatsAppStreamChunker(
+        max_length=settings.MAX_MESSAGE_LENGTH, min_length=settings.STREAM_CHUNK_MIN_LENGTH
+    )
+    parts: List[str] = []
+    stream = await client.chat.completions.create(stream=True, **params)
+    async for event in stream:
+        # Azure sends content-filter results as events without choices
+        if not event.choices:
+            continue
+        delta = event.choices[0].delta.content
+        if not delta:
+            continue
+        parts.append(delta)
+        for chunk in chunker.feed(delta):
+            await reply_stream.send(chunk)
+    for chunk in chunker.flush():
+        await reply_stream.send(chunk)
+    reply_stream.completed = True
+    return "".join(parts).strip()
+
+async def close_llm_client():
+    """Close the shared Azure OpenAI HTTP pool (called on app shutdown)"""
+    await client.close()
+
 def get_enhanced_system_prompt() -> str:
     """Returns the enhanced system prompt for crop disease identification"""
     return """You are Dr. AgriBot, an expert agricultural pathologist specializing in crop diseases of the Indian subcontinent. You have extensive knowledge of:
@@ -77,72 +202,49 @@ def extract_crop_type_from_ai_response(response: str) -> str:
     # Fallback to text extraction
     return extract_crop_type_from_text(response)
 
-async def chat_with_gpt(message: str, user_id: str = "") -> Tuple[str, str]:
+async def chat_with_gpt(
+    message: str,
+    user_id: str = "",
+    reply_stream: Optional[WhatsAppReplyStream] = None
+) -> Tuple[str, str]:
     """
     Enhanced text chat with session management - returns (response, crop_type)
+    With reply_stream, the reply is streamed and sent to WhatsApp as it is written.
     """
     try:
-        # Add user message to session
+        # Pick up turns handled by other workers, then add user message to session
+        await session_manager.refresh_session(user_id)
         add_user_message(user_id, message)
         
         # Get conversation history with system prompt
         system_prompt = get_enhanced_system_prompt()
-        conversation_history = get_conversation_history(user_id, system_prompt)
+        conversation_history = get_conversation_history(user_id, system_prompt, "chat")
         
         print(f"[CHAT] User {user_id}: {len(conversation_history)} messages in context")
         
-        # Type annotations for OpenAI messages
-        from openai.types.chat import (
-            ChatCompletionSystemMessageParam,
-            ChatCompletionUserMessageParam,
-            ChatCompletionAssistantMessageParam,
-        )
-        
-        # Convert conversation history to proper types
-        typed_messages: List[
-            ChatCompletionSystemMessageParam | 
-            ChatCompletionUserMessageParam | 
-            ChatCompletionAssistantMessageParam
-        ] = []
-        
-        for msg in conversation_history:
-            if msg["role"] == "system":
-                typed_messages.append(ChatCompletionSystemMessageParam(
-                    role="system",
-                    content=msg["content"]
-                ))
-            elif msg["role"] == "user":
-                if isinstance(msg["content"], str):
-                    typed_messages.append(ChatCompletionUserMessageParam(
-                        role="user",
-                        content=msg["content"]
-                    ))
-                else:
-                    # Handle image content
-                    typed_messages.append(ChatCompletionUserMessageParam(
-                        role="user",
-                        content=msg["content"]
-                    ))
-            elif msg["role"] == "assistant":
-                typed_messages.append(ChatCompletionAssistantMessageParam(
-                    role="assistant",
-                    content=msg["content"]
-                ))
+        # History dicts are already in OpenAI message shape - pass them through
+        # instead of copying each one into a typed param
+        from openai.types.chat import ChatCompletionMessageParam
+        typed_messages = cast(List[ChatCompletionMessageParam], conversation_history)
 
-        response = client.chat.completions.create(
-            model="gpt-4o",
+        params = dict(
+            model=settings.AZURE_OPENAI_DEPLOYMENT_NAME,
             messages=typed_messages,
             temperature=0.3,
             max_tokens=600,
             presence_penalty=0.1,
             frequency_penalty=0.1
         )
-        
-        content = response.choices[0].message.content
-        reply = content.strip() if content else ""
+        if reply_stream is not None:
+            reply = await _stream_completion(reply_stream, **params)
+        else:
+            response = await client.chat.completions.create(**params)
+            content = response.choices[0].message.content
+            reply = content.strip() if content else ""
         
         # Add assistant response to session
         add_assistant_message(user_id, reply)
+        await finish_session_turn(user_id)
         
         # Extract crop type from AI response
         crop_type = extract_crop_type_from_ai_response(reply)
@@ -154,20 +256,29 @@ async def chat_with_gpt(message: str, user_id: str = "") -> Tuple[str, str]:
         return reply, crop_type
         
     except Exception as e:
+        if is_retryable_failure(e, reply_stream):
+            # Nothing was sent yet: undo the turn and let the job be retried
+            session_manager.discard_turn(user_id)
+            raise TransientError(str(e)) from e
         error_msg = f"⚠️ Technical problem hai. Phir se try kariye. (Error: {str(e)})"
         # Add error message to session
         add_assistant_message(user_id, error_msg)
+        await session_manager.flush_session(user_id)
         return error_msg, ""
 
 async def analyze_crop_image(
     base64_image: str,
     user_id: Optional[str] = None,
-    prompt: Optional[str] = None
+    prompt: Optional[str] = None,
+    reply_stream: Optional[WhatsAppReplyStream] = None
 ) -> Tuple[str, str]:
     """
     Enhanced image analysis with session management - returns (analysis_result, crop_type)
+    With reply_stream, a fresh diagnosis is streamed and sent to WhatsApp as it is written.
     """
     
+    # Diagnoses are only shared between photos analysed with the default prompt
+    use_diagnosis_cache = not prompt
     if not prompt:
         prompt = """You are Dr. AgriBot, an expert agricultural pathologist for Indian farmers.
 
@@ -215,18 +326,42 @@ In the end, STRICTLY include a line saying: For more details contact: +91 85188
 IMPORTANT: Keep the total message under 800 characters for WhatsApp limits. Be concise but complete."""
 
     try:
+        # Downscale / re-orient / re-encode off the event loop before upload
+        image_bytes = base64.b64decode(base64_image)
+        image_ref = hashlib.sha256(image_bytes).hexdigest()
+        processed = await preprocess_image(image_bytes)
+        base64_image = base64.b64encode(processed.data).decode('utf-8')
+        
         # Add image message to session
         if user_id:
-            add_user_message(user_id, "[Image uploaded for analysis]", base64_image)
+            await session_manager.refresh_session(user_id)
+            add_user_message(user_id, "[Image uploaded for analysis]", base64_image, image_ref, processed.mime_type)
         
         # Get conversation history
         system_prompt = prompt
         if user_id:
-            conversation_history = get_conversation_history(user_id, system_prompt)
+            conversation_history = get_conversation_history(user_id, system_prompt, "image")
             print(f"[IMAGE_ANALYSIS] User {user_id}: {len(conversation_history)} messages in context")
         else:
             conversation_history = [{"role": "system", "content": system_prompt}]
         
+        # A diagnosis that drew on earlier turns (or the summary) is only reused
+        # for this farmer; one from the photo alone is shared with everyone
+        has_context = len(conversation_history) > 2
+        cache_scope = user_id if has_context else None
+        
+        # Same or near-identical photo diagnosed recently - skip the vision call
+        use_diagnosis_cache = use_diagnosis_cache and processed.phash is not None
+        if use_diagnosis_cache:
+            cached = diagnosis_cache.get(processed.phash, user_id)
+            if cached:
+                analysis_result, crop_type = cached
+                print(f"[IMAGE_ANALYSIS] Diagnosis cache hit for user {user_id}")
+                if user_id:
+                    add_assistant_message(user_id, analysis_result)
+                    await finish_session_turn(user_id)
+                return analysis_result, crop_type
+        
         from openai.types.chat import (
             ChatCompletionUserMessageParam,
             ChatCompletionContentPartTextParam,
@@ -241,7 +376,7 @@ IMPORTANT: Keep the total message under 800 characters for WhatsApp limits. Be c
         image_part = ChatCompletionContentPartImageParam(
             type="image_url",
             image_url={
-                "url": "data:image/jpeg;base64," + base64_image
+                "url": f"data:{processed.mime_type};base64," + base64_image
             }
         )
 
@@ -272,26 +407,49 @@ IMPORTANT: Keep the total message under 800 characters for WhatsApp limits. Be c
                 )
             ]
 
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-            temperature=0.2,
-            max_tokens=800
-        )
+        async def _complete() -> str:
+            params = dict(
+                model=settings.AZURE_OPENAI_DEPLOYMENT_NAME,
+                messages=messages,
+                temperature=0.2,
+                max_tokens=800
+            )
+            # Only the caller that starts the completion streams it; callers
+            # sharing it get the finished text. A failed send only holds back
+            # the leader's chunks, so it never fails the shared completion
+            if reply_stream is not None:
+                return await _stream_completion(reply_stream, **params)
+            response = await client.chat.completions.create(**params)
+            content = response.choices[0].message.content
+            return content.strip() if content else ""
         
-        content = response.choices[0].message.content
-        analysis_result = content.strip() if content else ""
+        if use_diagnosis_cache:
+            # Same photo already being analysed in the same scope - wait for that result.
+            # The completion carries the caller's history, so only history-free
+            # calls are shared across farmers
+            analysis_result = await llm_singleflight.do(("image", image_ref, cache_scope), _complete)
+        else:
+            analysis_result = await _complete()
         
         # Add analysis result to session
         if user_id:
             add_assistant_message(user_id, analysis_result)
+            await finish_session_turn(user_id)
         
         # Extract crop type from AI response
         crop_type = extract_crop_type_from_ai_response(analysis_result)
         
+        if use_diagnosis_cache and analysis_result:
+            diagnosis_cache.put(processed.phash, analysis_result, crop_type, cache_scope)
+        
         return analysis_result, crop_type
         
     except Exception as e:
+        if is_retryable_failure(e, reply_stream):
+            # Nothing was sent yet: undo the turn and let the job be retried
+            if user_id:
+                session_manager.discard_turn(user_id)
+            raise TransientError(str(e)) from e
         error_msg = f"⚠️ Image analysis mein problem hai"
         if "rate limit" in str(e).lower():
             error_msg += "\n🕐 1 minute baad try kariye"
@@ -303,23 +461,34 @@ IMPORTANT: Keep the total message under 800 characters for WhatsApp limits. Be c
         # Add error message to session
         if user_id:
             add_assistant_message(user_id, error_msg)
+            await session_manager.flush_session(user_id)
         
         return error_msg, ""
 
-def get_treatment_followup(disease: str, crop: str, user_id: Optional[str] = None) -> str:
+async def get_treatment_followup(disease: str, crop: str, user_id: Optional[str] = None) -> str:
     """Provides detailed treatment follow-up for identified diseases with session context"""
     
     # Add treatment request to session
+    treatment_request = f"Tell me more about treatment for {disease} in {crop}"
     if user_id:
-        treatment_request = f"Tell me more about treatment for {disease} in {crop}"
+        await session_manager.refresh_session(user_id)
         add_user_message(user_id, treatment_request)
     
-    prompt = f"""Based on our conversation history, provide detailed treatment guidance for {disease} in {crop} for Indian farmers.
+    # Cache hit skips the model but is still recorded in the user's session
+    cache_key = treatment_cache_key(disease, crop)
+    cached = treatment_cache.get(cache_key)
+    if cached:
+        print(f"[TREATMENT] Cache hit for {cache_key}")
+        if user_id:
+            add_assistant_message(user_id, cached)
+            await finish_session_turn(user_id)
+        return cached
+    
+    prompt = f"""Provide detailed treatment guidance for {disease} in {crop} for Indian farmers.
 
-CONVERSATION CONTEXT:
-- Reference our previous discussion about this crop/disease
-- Build upon earlier recommendations
-- Consider what the farmer has already tried (if mentioned)
+GENERAL GUIDANCE:
+- This answer is shared with many farmers, so do not refer to any earlier conversation, photo or diagnosis
+- Do not assume what the farmer has already tried; cover first-line and follow-up options
 
 MANDATORY: Respond in HINDI only (with only english used for farming hindi terms just after them inside the bracket ).
 
@@ -346,11 +515,12 @@ Include:
 Keep it practical and affordable for small Indian farmers. Response should be under 1000 characters."""
     
     try:
-        # Get conversation history if user_id provided
-        if user_id:
-            conversation_history = get_conversation_history(user_id, prompt)
-        else:
-            conversation_history = [{"role": "user", "content": prompt}]
+        # The answer is shared through the cache, so it is generated without
+        # this user's conversation history
+        conversation_history = [
+            {"role": "system", "content": prompt},
+            {"role": "user", "content": treatment_request},
+        ]
         
         # Convert conversation_history to proper OpenAI message types
         from openai.types.chat import (
@@ -376,19 +546,26 @@ Keep it practical and affordable for small Indian farmers. Response should be un
                     content=msg["content"]
                 ))
 
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=typed_messages,
-            temperature=0.3,
-            max_tokens=600
-        )
+        async def _complete() -> str:
+            response = await client.chat.completions.create(
+                model=settings.AZURE_OPENAI_DEPLOYMENT_NAME,
+                messages=typed_messages,
+                temperature=0.3,
+                max_tokens=600
+            )
+            content = response.choices[0].message.content
+            result = content.strip() if content else ""
+            if result:
+                treatment_cache.set(cache_key, result)
+            return result
         
-        content = response.choices[0].message.content
-        treatment_response = content.strip() if content else ""
+        # Farmers asking the same question at once share one completion
+        treatment_response = await llm_singleflight.do(("treatment", cache_key), _complete)
         
         # Add treatment response to session
         if user_id:
             add_assistant_message(user_id, treatment_response)
+            await finish_session_turn(user_id)
         
         return treatment_response
         
@@ -396,6 +573,7 @@ Keep it practical and affordable for small Indian farmers. Response should be un
         error_msg = f"⚠️ Treatment info mein problem: {str(e)}"
         if user_id:
             add_assistant_message(user_id, error_msg)
+            await session_manager.flush_session(user_id)
         return error_msg
 
 # Session management utility functions
@@ -403,9 +581,9 @@ def get_user_session_info(user_id: str) -> Optional[Dict]:
     """Get session information for a user"""
     return session_manager.get_session_info(user_id)
 
-def clear_user_conversation(user_id: str) -> bool:
-    """Clear user's conversation history"""
-    return session_manager.clear_session(user_id)
+async def clear_user_conversation(user_id: str) -> bool:
+    """Clear user's conversation history on every worker"""
+    return await session_manager.clear_shared_session(user_id)
 
 def get_active_sessions_count() -> int:
     """Get count of active sessions"""
@@ -413,4 +591,8 @@ def get_active_sessions_count() -> int:
 
 def get_all_sessions_info() -> Dict:
     """Get information about all active sessions"""
-    return session_manager.get_all_sessions_info()
\ No newline at end of file
+    return session_manager.get_all_sessions_info()
+
+def get_session_memory_stats() -> Dict:
+    """Get session memory usage against the budget"""
+    return session_manager.get_memory_stats()
\ No newline at end of file
@@ -0,0 +1,115 @@
+import asyncio
+import io
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Optional, Tuple
+from app.config import settings
+from app.utils.helper import detect_image_mime
+
+PIL_FORMAT_MIME = {
+    "JPEG": "image/jpeg",
+    "PNG": "image/png",
+    "WEBP": "image/webp",
+    "GIF": "image/gif",
+}
+
+@dataclass
+class PreprocessedImage:
+    """Image ready for the vision model"""
+    data: bytes
+    mime_type: str
+    original_size: int
+    width: int = 0
+    height: int = 0
+    phash: Optional[int] = None  # 64-bit dHash, for near-duplicate lookup
+
+# CPU-bound decode/resize/encode runs here so the event loop stays free
+_executor: Optional[ProcessPoolExecutor] = None
+
+def dhash(img, hash_size: int = 8) -> int:
+    """Difference hash: 64 bits comparing neighbouring pixels of a 9x8 thumbnail.
+
+    Robust to re-compression, resizing and small exposure changes, so a
+    resent or slightly re-shot photo lands within a few bits of the original.
+    """
+    import numpy as np
+    from PIL import Image
+
+    small = img.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+def _preprocess_sync(data: bytes, max_edge: int, quality: int) -> Tuple[bytes, str, int, int, int]:
+    """Decode, apply EXIF orientation, downscale and re-encode as JPEG.
+
+    Runs in a worker process. Returns the original bytes when they are
+    already small enough and correctly oriented, plus the image's dHash.
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as img:
+        source_mime = PIL_FORMAT_MIME.get(img.format or "", detect_image_mime(data))
+        orientation = img.getexif().get(0x0112, 1)  # EXIF Orientation tag
+        needs_resize = max(img.size) > max_edge
+
+        if not needs_resize and orientation == 1 and source_mime in ("image/jpeg", "image/png", "image/webp"):
+            return data, source_mime, img.width, img.height, dhash(img)
+
+        img = ImageOps.exif_transpose(img)
+        phash = dhash(img)
+        if needs_resize:
+            img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+        # JPEG has no alpha channel - flatten transparent images onto white
+        if img.mode in ("RGBA", "LA", "P"):
+            img = img.convert("RGBA")
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            background.paste(img, mask=img.split()[-1])
+            img = background
+        elif img.mode != "RGB":
+            img = img.convert("RGB")
+
+        out = io.BytesIO()
+        img.save(out, format="JPEG", quality=quality, optimize=True)
+        return out.getvalue(), "image/jpeg", img.width, img.height, phash
+
+async def preprocess_image(data: bytes) -> PreprocessedImage:
+    """Prepare a farmer's photo for the vision model without blocking the loop.
+
+    Falls back to the original bytes (with sniffed MIME type) when the image
+    cannot be decoded, e.g. HEIC without a Pillow plugin.
+    """
+    args = (data, settings.IMAGE_MAX_EDGE, settings.IMAGE_JPEG_QUALITY)
+    try:
+        if _executor is not None:
+            loop = asyncio.get_running_loop()
+            processed, mime_type, width, height, phash = await loop.run_in_executor(_executor, _preprocess_sync, *args)
+        else:
+            processed, mime_type, width, height, phash = await asyncio.to_thread(_preprocess_sync, *args)
+    except Exception as e:
+        print(f"[IMAGE_PREPROCESS] Could not preprocess image, sending original: {e}")
+        return PreprocessedImage(data=data, mime_type=detect_image_mime(data), original_size=len(data))
+
+    print(f"[IMAGE_PREPROCESS] {len(data)} -> {len(processed)} bytes ({width}x{height}, {mime_type})")
+    return PreprocessedImage(
+        data=processed,
+        mime_type=mime_type,
+        original_size=len(data),
+        width=width,
+        height=height,
+        phash=phash,
+    )
+
+def start_preprocessing_pool():
+    """Spawn the image worker processes (called on app startup)"""
+    global _executor
+    if _executor is None and settings.IMAGE_PREPROCESS_WORKERS > 0:
+        _executor = ProcessPoolExecutor(max_workers=settings.IMAGE_PREPROCESS_WORKERS)
+
+def stop_preprocessing_pool():
+    """Shut the image worker processes down (called on app shutdown)"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
@@ -0,0 +1,140 @@
+import asyncio
+import hashlib
+import os
+import uuid
+from abc import ABC, abstractmethod
+from typing import Dict, Optional
+from bson import ObjectId
+from gridfs import AsyncGridFSBucket
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from app.config import settings
+from app.utils.helper import detect_image_mime
+
+def image_ref(data: bytes, mime_type: Optional[str] = None) -> Dict:
+    """Content address of an image: SHA-256 plus size and MIME type"""
+    return {
+        "sha256": hashlib.sha256(data).hexdigest(),
+        "size": len(data),
+        "mime_type": mime_type or detect_image_mime(data),
+    }
+
+class ImageStore(ABC):
+    """Content-addressed image storage - each distinct photo is stored once"""
+
+    async def setup(self):
+        """Create indexes/directories; called once on startup"""
+
+    @abstractmethod
+    async def exists(self, sha256: str) -> bool:
+        ...
+
+    @abstractmethod
+    async def _write(self, ref: Dict, data: bytes) -> bool:
+        """Store the bytes; False when a concurrent upload stored them first"""
+
+    @abstractmethod
+    async def get(self, sha256: str) -> Optional[bytes]:
+        ...
+
+    async def put(self, data: bytes, mime_type: Optional[str] = None) -> Dict:
+        """Store an image unless the same bytes are already stored; returns its ref"""
+        ref = image_ref(data, mime_type)
+        if await self.exists(ref["sha256"]) or not await self._write(ref, data):
+            print(f"[IMAGE_STORE] Duplicate image {ref['sha256'][:12]}, skipped upload")
+        else:
+            print(f"[IMAGE_STORE] Stored image {ref['sha256'][:12]} ({ref['size']} bytes)")
+        return ref
+
+class GridFSImageStore(ImageStore):
+    """Images in MongoDB GridFS, filename = SHA-256"""
+
+    def __init__(self):
+        from app.services.mongo_db import db
+        self.bucket = AsyncGridFSBucket(db, bucket_name="images")
+        self.files = db["images.files"]
+        self.chunks = db["images.chunks"]
+
+    async def setup(self):
+        # One file per hash, so concurrent uploads of the same photo can't both land
+        try:
+            indexes = await self.files.index_information()
+            if "filename_1" in indexes and not indexes["filename_1"].get("unique"):
+                await self.files.drop_index("filename_1")
+            await self.files.create_index("filename", unique=True)
+        except OperationFailure as e:
+            print(f"[IMAGE_STORE] Could not create unique filename index (duplicate images stored?): {e}")
+        except Exception as e:
+            # e.g. Mongo unreachable at startup - uploads still work, only unindexed
+            print(f"[IMAGE_STORE] Index setup failed: {e}")
+
+    async def exists(self, sha256: str) -> bool:
+        return await self.files.find_one({"filename": sha256}, {"_id": 1}) is not None
+
+    async def _write(self, ref: Dict, data: bytes) -> bool:
+        file_id = ObjectId()
+        try:
+            await self.bucket.upload_from_stream_with_id(
+                file_id,
+                ref["sha256"],
+                data,
+                metadata={"mime_type": ref["mime_type"], "size": ref["size"]},
+            )
+        except DuplicateKeyError:
+            # Lost the race: the files document was rejected, drop our chunks
+            await self.chunks.delete_many({"files_id": file_id})
+            return False
+        return True
+
+    async def get(self, sha256: str) -> Optional[bytes]:
+        if not await self.exists(sha256):
+            return None
+        stream = await self.bucket.open_download_stream_by_name(sha256)
+        return await stream.read()
+
+class LocalImageStore(ImageStore):
+    """Images on the local filesystem under <root>/<aa>/<bb>/<sha256>"""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, sha256: str) -> str:
+        return os.path.join(self.root, sha256[:2], sha256[2:4], sha256)
+
+    async def setup(self):
+        os.makedirs(self.root, exist_ok=True)
+
+    async def exists(self, sha256: str) -> bool:
+        return await asyncio.to_thread(os.path.exists, self._path(sha256))
+
+    async def _write(self, ref: Dict, data: bytes) -> bool:
+        def _write_file():
+            path = self._path(ref["sha256"])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write then rename so readers never see a partial file
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"  # unique per upload, not just per process
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            # Same hash, same bytes: a concurrent rename of the same photo is harmless
+            os.replace(tmp_path, path)
+        await asyncio.to_thread(_write_file)
+        return True
+
+    async def get(self, sha256: str) -> Optional[bytes]:
+        def _read_file():
+            try:
+                with open(self._path(sha256), "rb") as f:
+                    return f.read()
+            except FileNotFoundError:
+                return None
+        return await asyncio.to_thread(_read_file)
+
+def create_image_store() -> ImageStore:
+    """Pick the image store backend from settings"""
+    if settings.IMAGE_STORE_BACKEND == "gridfs":
+        return GridFSImageStore()
+    if settings.IMAGE_STORE_BACKEND == "local":
+        return LocalImageStore(settings.IMAGE_STORE_PATH)
+    raise ValueError(f"Unknown IMAGE_STORE_BACKEND: {settings.IMAGE_STORE_BACKEND}")
+
+# Global image store instance
+image_store = create_image_store()
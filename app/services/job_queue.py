@@ -0,0 +1,382 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from app.config import settings
+
+# Job lifecycle: pending -> processing -> done
+#                             |-> pending (retry after backoff)
+#                             |-> dead (attempts exhausted)
+STATUS_PENDING = "pending"
+STATUS_PROCESSING = "processing"
+STATUS_DONE = "done"
+STATUS_DEAD = "dead"
+
+class DuplicateJobError(Exception):
+    """A job with the same id (Twilio MessageSid) was already enqueued"""
+
+def retry_delay(attempts: int) -> float:
+    """Exponential backoff between attempts, capped at 5 minutes"""
+    return min(settings.JOB_RETRY_BASE_DELAY_SECONDS * (2 ** max(attempts - 1, 0)), 300.0)
+
+class JobStore(ABC):
+    """Persistent queue of inbound message jobs with visibility timeouts.
+
+    A claimed job stays invisible to other workers until its lease runs out,
+    so a job held by a crashed process is picked up again automatically.
+    Jobs of the same user are never processed concurrently, across every
+    worker process: a user's job is only claimed while none of their other
+    jobs holds a live lease.
+    Jobs are dicts with ``id``, ``payload``, ``user_id``, ``attempts`` and ``lease``.
+    """
+
+    async def setup(self):
+        """Create tables/indexes; called once on startup"""
+
+    @abstractmethod
+    async def enqueue(self, payload: Dict, job_id: Optional[str] = None, user_id: Optional[str] = None) -> str:
+        """Insert a job; raises DuplicateJobError when job_id already exists"""
+
+    @abstractmethod
+    async def claim(self, visibility_timeout: float) -> Optional[Dict]:
+        """Lease the oldest visible job of a user without a running job, or return None when idle"""
+
+    @abstractmethod
+    async def extend(self, job: Dict, visibility_timeout: float) -> bool:
+        """Push the lease deadline out; returns False when the lease was lost"""
+
+    @abstractmethod
+    async def complete(self, job: Dict):
+        ...
+
+    @abstractmethod
+    async def fail(self, job: Dict, error: str, retry: bool = True) -> str:
+        """Schedule a retry or dead-letter the job; returns the new status"""
+
+    @abstractmethod
+    async def release(self, job: Dict):
+        """Hand a job back without counting the attempt (graceful shutdown)"""
+
+    @abstractmethod
+    async def stats(self) -> Dict:
+        ...
+
+class MongoJobStore(JobStore):
+    """Job store on the shared MongoDB database (``jobs`` collection).
+
+    Per-user exclusion uses a lease document per busy user in ``job_users``;
+    a job whose user is busy is handed back and retried shortly.
+    """
+
+    # Claimed jobs of a busy user tried per claim before giving up until the next poll
+    CLAIM_SCAN_LIMIT = 10
+
+    def __init__(self):
+        from app.services.mongo_db import db
+        self.collection = db["jobs"]
+        self.user_leases = db["job_users"]
+
+    async def setup(self):
+        await self.collection.create_index([("status", 1), ("visible_at", 1)])
+        # Finished jobs are kept for a week for auditing, then expire
+        await self.collection.create_index("expire_at", expireAfterSeconds=0)
+        # Released and abandoned user leases are cleaned up once past their deadline
+        await self.user_leases.create_index("expires_at", expireAfterSeconds=0)
+
+    async def enqueue(self, payload: Dict, job_id: Optional[str] = None, user_id: Optional[str] = None) -> str:
+        now = datetime.now()
+        job_id = job_id or uuid.uuid4().hex
+        try:
+            await self.collection.insert_one({
+                "_id": job_id,
+                "payload": payload,
+                "user_id": user_id,
+                "status": STATUS_PENDING,
+                "attempts": 0,
+                "visible_at": now,
+                "lease": None,
+                "last_error": None,
+                "created_at": now,
+                "updated_at": now,
+            })
+        except DuplicateKeyError:
+            raise DuplicateJobError(job_id)
+        return job_id
+
+    async def claim(self, visibility_timeout: float) -> Optional[Dict]:
+        for _ in range(self.CLAIM_SCAN_LIMIT):
+            now = datetime.now()
+            deadline = now + timedelta(seconds=visibility_timeout)
+            doc = await self.collection.find_one_and_update(
+                {
+                    "status": {"$in": [STATUS_PENDING, STATUS_PROCESSING]},
+                    "visible_at": {"$lte": now},
+                },
+                {
+                    "$set": {
+                        "status": STATUS_PROCESSING,
+                        "visible_at": deadline,
+                        "lease": uuid.uuid4().hex,
+                        "updated_at": now,
+                    },
+                    "$inc": {"attempts": 1},
+                },
+                sort=[("visible_at", 1)],
+                return_document=ReturnDocument.AFTER,
+            )
+            if not doc:
+                return None
+            job = {
+                "id": doc["_id"],
+                "payload": doc["payload"],
+                "user_id": doc.get("user_id"),
+                "attempts": doc["attempts"],
+                "lease": doc["lease"],
+            }
+            if await self._lock_user(job, now, deadline):
+                return job
+            # The user's previous message is still running: hand this one back
+            # without counting the attempt and look at the next job
+            await self.collection.update_one(
+                {"_id": job["id"], "lease": job["lease"]},
+                {
+                    "$set": {
+                        "status": STATUS_PENDING,
+                        "lease": None,
+                        "visible_at": now + timedelta(seconds=settings.JOB_POLL_INTERVAL_SECONDS),
+                    },
+                    "$inc": {"attempts": -1},
+                },
+            )
+        return None
+
+    async def _lock_user(self, job: Dict, now: datetime, deadline: datetime) -> bool:
+        """Take the user's lease for this job; False while another job holds it"""
+        if not job["user_id"]:
+            return True
+        try:
+            # No match on a held, unexpired lease turns the upsert into a
+            # duplicate insert, which is how "busy" is detected atomically
+            await self.user_leases.update_one(
+                {"_id": job["user_id"], "$or": [{"lease": None}, {"expires_at": {"$lte": now}}]},
+                {"$set": {"lease": job["lease"], "expires_at": deadline}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            return False
+        return True
+
+    async def _unlock_user(self, job: Dict):
+        if job.get("user_id"):
+            await self.user_leases.update_one(
+                {"_id": job["user_id"], "lease": job["lease"]},
+                {"$set": {"lease": None}},
+            )
+
+    async def _finish(self, job: Dict, fields: Dict):
+        fields["updated_at"] = datetime.now()
+        # Only the current lease holder may settle the job
+        await self.collection.update_one(
+            {"_id": job["id"], "lease": job["lease"]},
+            {"$set": fields},
+        )
+        await self._unlock_user(job)
+
+    async def extend(self, job: Dict, visibility_timeout: float) -> bool:
+        now = datetime.now()
+        deadline = now + timedelta(seconds=visibility_timeout)
+        result = await self.collection.update_one(
+            {"_id": job["id"], "lease": job["lease"], "status": STATUS_PROCESSING},
+            {"$set": {"visible_at": deadline, "updated_at": now}},
+        )
+        if result.matched_count != 1:
+            return False
+        if job.get("user_id"):
+            await self.user_leases.update_one(
+                {"_id": job["user_id"], "lease": job["lease"]},
+                {"$set": {"expires_at": deadline}},
+            )
+        return True
+
+    async def complete(self, job: Dict):
+        await self._finish(job, {
+            "status": STATUS_DONE,
+            "lease": None,
+            "expire_at": datetime.now() + timedelta(days=7),
+        })
+
+    async def fail(self, job: Dict, error: str, retry: bool = True) -> str:
+        if not retry or job["attempts"] >= settings.JOB_MAX_ATTEMPTS:
+            await self._finish(job, {"status": STATUS_DEAD, "lease": None, "last_error": error})
+            return STATUS_DEAD
+        await self._finish(job, {
+            "status": STATUS_PENDING,
+            "lease": None,
+            "last_error": error,
+            "visible_at": datetime.now() + timedelta(seconds=retry_delay(job["attempts"])),
+        })
+        return STATUS_PENDING
+
+    async def release(self, job: Dict):
+        await self.collection.update_one(
+            {"_id": job["id"], "lease": job["lease"]},
+            {
+                "$set": {"status": STATUS_PENDING, "lease": None, "visible_at": datetime.now()},
+                "$inc": {"attempts": -1},
+            },
+        )
+        await self._unlock_user(job)
+
+    async def stats(self) -> Dict:
+        pipeline = [{"$group": {"_id": "$status", "count": {"$sum": 1}}}]
+        cursor = await self.collection.aggregate(pipeline)
+        return {row["_id"]: row["count"] async for row in cursor}
+
+class SQLiteJobStore(JobStore):
+    """Single-file job store for local development without MongoDB"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._lock = threading.Lock()
+
+    def _execute(self, sql: str, params: tuple = ()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    async def setup(self):
+        await asyncio.to_thread(self._execute, """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                visible_at REAL NOT NULL,
+                lease TEXT,
+                user_id TEXT,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        columns = await asyncio.to_thread(self._execute, "PRAGMA table_info(jobs)")
+        if "user_id" not in {column[1] for column in columns}:
+            # Queue files created before per-user exclusion
+            await asyncio.to_thread(self._execute, "ALTER TABLE jobs ADD COLUMN user_id TEXT")
+        await asyncio.to_thread(
+            self._execute, "CREATE INDEX IF NOT EXISTS idx_jobs_visible ON jobs (status, visible_at)"
+        )
+        await asyncio.to_thread(
+            self._execute, "CREATE INDEX IF NOT EXISTS idx_jobs_user ON jobs (user_id, status)"
+        )
+
+    async def enqueue(self, payload: Dict, job_id: Optional[str] = None, user_id: Optional[str] = None) -> str:
+        now = time.time()
+        job_id = job_id or uuid.uuid4().hex
+        try:
+            await asyncio.to_thread(
+                self._execute,
+                "INSERT INTO jobs (id, payload, user_id, status, attempts, visible_at, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, 0, ?, ?, ?)",
+                (job_id, json.dumps(payload), user_id, STATUS_PENDING, now, now, now),
+            )
+        except sqlite3.IntegrityError:
+            raise DuplicateJobError(job_id)
+        return job_id
+
+    def _claim_sync(self, visibility_timeout: float) -> Optional[Dict]:
+        now = time.time()
+        lease = uuid.uuid4().hex
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Skip users with another job under a live lease
+                row = self._conn.execute(
+                    "SELECT id, payload, attempts, user_id FROM jobs AS j "
+                    "WHERE status IN (?, ?) AND visible_at <= ? AND NOT EXISTS ("
+                    "  SELECT 1 FROM jobs AS busy WHERE busy.user_id = j.user_id AND busy.id != j.id"
+                    "  AND busy.status = ? AND busy.visible_at > ?"
+                    ") ORDER BY visible_at LIMIT 1",
+                    (STATUS_PENDING, STATUS_PROCESSING, now, STATUS_PROCESSING, now),
+                ).fetchone()
+                if row is None:
+                    self._conn.execute("COMMIT")
+                    return None
+                self._conn.execute(
+                    "UPDATE jobs SET status = ?, visible_at = ?, lease = ?, attempts = attempts + 1, updated_at = ? "
+                    "WHERE id = ?",
+                    (STATUS_PROCESSING, now + visibility_timeout, lease, now, row[0]),
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return {"id": row[0], "payload": json.loads(row[1]), "user_id": row[3], "attempts": row[2] + 1, "lease": lease}
+
+    async def claim(self, visibility_timeout: float) -> Optional[Dict]:
+        return await asyncio.to_thread(self._claim_sync, visibility_timeout)
+
+    def _extend_sync(self, job: Dict, visibility_timeout: float) -> bool:
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET visible_at = ?, updated_at = ? WHERE id = ? AND lease = ? AND status = ?",
+                (now + visibility_timeout, now, job["id"], job["lease"], STATUS_PROCESSING),
+            )
+            return cursor.rowcount == 1
+
+    async def extend(self, job: Dict, visibility_timeout: float) -> bool:
+        return await asyncio.to_thread(self._extend_sync, job, visibility_timeout)
+
+    async def complete(self, job: Dict):
+        await asyncio.to_thread(
+            self._execute,
+            "UPDATE jobs SET status = ?, lease = NULL, updated_at = ? WHERE id = ? AND lease = ?",
+            (STATUS_DONE, time.time(), job["id"], job["lease"]),
+        )
+
+    async def fail(self, job: Dict, error: str, retry: bool = True) -> str:
+        now = time.time()
+        if not retry or job["attempts"] >= settings.JOB_MAX_ATTEMPTS:
+            status, visible_at = STATUS_DEAD, now
+        else:
+            status, visible_at = STATUS_PENDING, now + retry_delay(job["attempts"])
+        await asyncio.to_thread(
+            self._execute,
+            "UPDATE jobs SET status = ?, lease = NULL, last_error = ?, visible_at = ?, updated_at = ? "
+            "WHERE id = ? AND lease = ?",
+            (status, error, visible_at, now, job["id"], job["lease"]),
+        )
+        return status
+
+    async def release(self, job: Dict):
+        now = time.time()
+        await asyncio.to_thread(
+            self._execute,
+            "UPDATE jobs SET status = ?, lease = NULL, attempts = attempts - 1, visible_at = ?, updated_at = ? "
+            "WHERE id = ? AND lease = ?",
+            (STATUS_PENDING, now, now, job["id"], job["lease"]),
+        )
+
+    async def stats(self) -> Dict:
+        rows = await asyncio.to_thread(self._execute, "SELECT status, COUNT(*) FROM jobs GROUP BY status")
+        return {status: count for status, count in rows}
+
+def create_job_store() -> JobStore:
+    """Pick the job store backend from settings (auto = Mongo when configured)"""
+    backend = settings.JOB_QUEUE_BACKEND
+    if backend == "auto":
+        backend = "mongo" if settings.MONGO_URI else "sqlite"
+    if backend == "mongo":
+        return MongoJobStore()
+    if backend == "sqlite":
+        return SQLiteJobStore(settings.JOB_QUEUE_SQLITE_PATH)
+    raise ValueError(f"Unknown JOB_QUEUE_BACKEND: {backend}")
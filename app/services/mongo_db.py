@@ -1,109 +1,308 @@
-from pymongo import MongoClient
+import asyncio
+import time
+from typing import Dict, List, Optional
+from bson import ObjectId
+from pymongo import AsyncMongoClient, ReturnDocument
+from pymongo.errors import BulkWriteError
 from app.config import settings
 from app.utils.helper import extract_phone_number
 from datetime import datetime
 from app.models import MessageSchema, UserSchema
+from app.utils.cache import TTLCache
 
-client = MongoClient(settings.MONGO_URI)
+# Async client - connections are pooled and opened lazily on first use
+client = AsyncMongoClient(
+    settings.MONGO_URI,
+    maxPoolSize=settings.MONGO_MAX_POOL_SIZE,
+    minPoolSize=settings.MONGO_MIN_POOL_SIZE,
+    connectTimeoutMS=settings.MONGO_CONNECT_TIMEOUT_MS,
+    serverSelectionTimeoutMS=settings.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    socketTimeoutMS=settings.MONGO_SOCKET_TIMEOUT_MS,
+)
 db = client["whatsapp_bot"]
 
 # Collections
 users_collection = db["users"]
 messages_collection = db["messages"]
 
+class MessageWriteBuffer:
+    """Write-behind buffer that batches message documents into insert_many.
 
-def save_user(user_id: str, phone_number: str = "", name: str = ""):
+    Documents are flushed when the batch reaches ``batch_size`` or
+    ``flush_interval`` seconds after the first queued document. The queue is
+    bounded, so producers wait (backpressure) when Mongo falls behind. A
+    failed flush is retried with exponential backoff and only dropped after
+    ``max_retries`` retries.
+    """
+
+    def __init__(self, collection, batch_size: int = 100, flush_interval: float = 0.5, max_pending: int = 5000,
+                 max_retries: int = 5, retry_delay: float = 0.5):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_pending)
+        self._task: Optional[asyncio.Task] = None
+        self._batch: List[Dict] = []  # batch being collected/written, kept for stop()
+        self.flushes = 0
+        self.documents_written = 0
+        self.documents_dropped = 0
+        self.retries = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def add(self, document: Dict):
+        """Queue a document; waits while the buffer is full"""
+        await self._queue.put(document)
+
+    async def _collect_batch(self):
+        self._batch.append(await self._queue.get())
+        deadline = time.monotonic() + self.flush_interval
+        while len(self._batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                self._batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+
+    async def _write(self, batch: List[Dict]):
+        failed = []
+        attempt = 0
+        while True:
+            try:
+                await self.collection.insert_many(batch, ordered=False)
+            except BulkWriteError as e:
+                # Documents carry their own _id, so re-flushing a partly written
+                # batch only reports duplicates for the rows that already landed
+                errors = e.details.get("writeErrors", [])
+                failed = [err for err in errors if err.get("code") != 11000]
+                if failed:
+                    self.documents_dropped += len(failed)
+                    print(f"[DB] Message flush failed, {len(failed)} messages not saved: {failed[0].get('errmsg')}")
+            except Exception as e:
+                # Connection or server trouble: safe to replay the whole batch
+                # for the same reason; producers wait on the full queue meanwhile
+                if attempt >= self.max_retries:
+                    self.documents_dropped += len(batch)
+                    print(f"[DB] Message flush failed after {attempt} retries, {len(batch)} messages not saved: {e}")
+                    return
+                delay = self.retry_delay * (2 ** attempt)
+                attempt += 1
+                self.retries += 1
+                print(f"[DB] Message flush failed, retrying in {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+                continue
+            break
+        self.flushes += 1
+        self.documents_written += len(batch) - len(failed)
+        print(f"[DB] Flushed {len(batch)} messages")
+
+    async def _run(self):
+        while True:
+            await self._collect_batch()
+            await self._write(self._batch)
+            self._batch = []
+
+    def start(self):
+        if not self.running:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the flusher and write out everything still queued"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        pending, self._batch = self._batch, []
+        while not self._queue.empty():
+            pending.append(self._queue.get_nowait())
+        for i in range(0, len(pending), self.batch_size):
+            await self._write(pending[i:i + self.batch_size])
+
+    def get_stats(self) -> Dict:
+        return {
+            "pending": self._queue.qsize(),
+            "flushes": self.flushes,
+            "documents_written": self.documents_written,
+            "documents_dropped": self.documents_dropped,
+            "retries": self.retries,
+        }
+
+# Global write-behind buffer for the messages collection
+message_buffer = MessageWriteBuffer(
+    messages_collection,
+    batch_size=settings.MESSAGE_FLUSH_BATCH_SIZE,
+    flush_interval=settings.MESSAGE_FLUSH_INTERVAL_SECONDS,
+    max_pending=settings.MESSAGE_BUFFER_MAX_SIZE,
+    max_retries=settings.MESSAGE_FLUSH_MAX_RETRIES,
+    retry_delay=settings.MESSAGE_FLUSH_RETRY_BASE_DELAY_SECONDS,
+)
+
+# In-process cache of user records shared by save_user / save_message /
+# get_user_phone. Unknown users are cached as {} until save_user writes them.
+user_cache = TTLCache(max_size=settings.USER_CACHE_MAX_SIZE, ttl=settings.USER_CACHE_TTL_SECONDS)
+USER_PROJECTION = {"_id": 0, "user_id": 1, "phone_number": 1, "name": 1}
+
+async def get_user(user_id: str) -> Dict:
+    """Get a user record through the cache ({} when the user does not exist)"""
+    user = user_cache.get(user_id)
+    if user is None:
+        user = await users_collection.find_one({"user_id": user_id}, USER_PROJECTION) or {}
+        user_cache.set(user_id, user)
+    return user
+
+async def ensure_indexes():
+    """Create the indexes the hot queries rely on (idempotent, run on startup)"""
+    try:
+        await users_collection.create_index("user_id", unique=True)
+        # get_recent_messages filters by user and sorts by newest first
+        await messages_collection.create_index([("user_id", 1), ("timestamp", -1)])
+        print("[DB] Indexes ready")
+    except Exception as e:
+        # e.g. legacy duplicate users block the unique index - app still works
+        print(f"[DB] Index creation failed: {e}")
+
+async def save_user(user_id: str, phone_number: str = "", name: str = ""):
     """Save user info only once - prevents duplicates"""
     # Clean phone number
     clean_phone = extract_phone_number(phone_number) if phone_number else ""
     
-    # Check if user already exists
-    existing_user = users_collection.find_one({"user_id": user_id})
+    # Nothing to write if the cached record already has everything we know
+    cached_user = user_cache.get(user_id)
+    if cached_user and (not clean_phone or cached_user.get("phone_number")):
+        return
+    
+    # Single atomic upsert: insert new users, fill in a missing phone number,
+    # otherwise leave the stored record untouched
+    now = datetime.now()
+    defaults = UserSchema(
+        user_id=user_id,
+        phone_number=clean_phone,
+        name=name if name else None,
+        created_at=now,
+        updated_at=now
+    ).dict()
+    has_phone = {"$gt": [{"$strLenCP": {"$ifNull": ["$phone_number", ""]}}, 0]}
+    fill_phone = {"$and": [bool(clean_phone), {"$not": [has_phone]}]}
+    previous = await users_collection.find_one_and_update(
+        {"user_id": user_id},
+        [{
+            "$set": {
+                "user_id": user_id,
+                "name": {"$ifNull": ["$name", defaults["name"]]},
+                "created_at": {"$ifNull": ["$created_at", now]},
+                "phone_number": {"$cond": [has_phone, "$phone_number", clean_phone]},
+                "updated_at": {"$cond": [fill_phone, now, {"$ifNull": ["$updated_at", now]}]},
+            }
+        }],
+        projection=USER_PROJECTION,
+        upsert=True,
+        return_document=ReturnDocument.BEFORE
+    )
     
-    if not existing_user:
-        user_data = UserSchema(
-            user_id=user_id,
-            phone_number=clean_phone,
-            name=name if name else None
-        ).dict()
-        users_collection.insert_one(user_data)
+    # Write-through so the next lookup for this user is a cache hit
+    if not previous:
+        user_cache.set(user_id, {k: defaults[k] for k in ("user_id", "phone_number", "name")})
         print(f"[DB] New user saved: {user_id} | Phone: {clean_phone}")
+    elif clean_phone and not previous.get("phone_number"):
+        user_cache.set(user_id, {**previous, "phone_number": clean_phone})
+        print(f"[DB] User phone updated: {user_id} | Phone: {clean_phone}")
     else:
-        # Update phone number if it wasn't stored before
-        if clean_phone and not existing_user.get("phone_number"):
-            users_collection.update_one(
-                {"user_id": user_id},
-                {
-                    "$set": {
-                        "phone_number": clean_phone,
-                        "updated_at": datetime.now()
-                    }
-                }
-            )
-            print(f"[DB] User phone updated: {user_id} | Phone: {clean_phone}")
-
-def save_message(user_id: str, message: str = "", image_base64: str = "", 
-                is_bot: bool = False, crop_type: str = ""):
-    """Save message with all required fields"""
+        user_cache.set(user_id, previous)
+
+async def save_message(user_id: str, message: str = "", image: Optional[Dict] = None, 
+                is_bot: bool = False, crop_type: str = "", is_template: bool = False):
+    """Save message with all required fields (image = ref from the image store).
+    is_template marks fixed bot text that is never part of the model's context."""
     
     # Get user's phone number
-    user = users_collection.find_one({"user_id": user_id})
-    phone_number = user.get("phone_number", "") if user else ""
+    user = await get_user(user_id)
+    phone_number = user.get("phone_number", "")
     
     message_obj = MessageSchema(
         user_id=user_id,
         phone_number=phone_number,
         message=message,
-        image_base64=image_base64,
+        image_sha256=image["sha256"] if image else None,
+        image_size=image["size"] if image else None,
+        image_mime_type=image["mime_type"] if image else None,
         crop_type=crop_type,
-        is_bot=is_bot
+        is_bot=is_bot,
+        is_template=is_template
     )
     message_data = message_obj.dict()
+    # Assign the id up front so callers get it even though the write is deferred
+    message_data["_id"] = ObjectId()
     
-    result = messages_collection.insert_one(message_data)
+    if message_buffer.running:
+        await message_buffer.add(message_data)
+    else:
+        await messages_collection.insert_one(message_data)
     print(f"[DB] Message saved: {user_id} | Bot: {is_bot} | Crop: {crop_type}")
-    return result.inserted_id
+    return message_data["_id"]
 
-def get_user_phone(user_id: str) -> str:
+async def get_user_phone(user_id: str) -> str:
     """Get user's phone number"""
-    user = users_collection.find_one({"user_id": user_id})
-    return user.get("phone_number", "") if user else ""
+    user = await get_user(user_id)
+    return user.get("phone_number", "")
 
-def get_recent_messages(user_id: str, limit: int = 10):
-    """Get recent messages for a user (for context if needed)"""
-    messages = messages_collection.find(
-        {"user_id": user_id}
+async def get_recent_messages(user_id: str, limit: int = 10, since: Optional[datetime] = None,
+                              projection: Optional[Dict] = None):
+    """Get recent messages for a user, newest first (served by the user_id/timestamp index)"""
+    query: Dict = {"user_id": user_id}
+    if since is not None:
+        query["timestamp"] = {"$gte": since}
+    cursor = messages_collection.find(
+        query, projection
     ).sort("timestamp", -1).limit(limit)
     
-    return list(messages)
+    return await cursor.to_list(length=limit)
+
+async def close_mongo_client():
+    """Flush buffered messages and close the MongoDB connection pool (called on app shutdown)"""
+    await message_buffer.stop()
+    await client.close()
+
+# Common crop keywords in Hindi and English
+CROP_ALIASES = {
+    'rice': ['rice', 'chawal', 'dhan', 'paddy', 'धान', 'चावल'],
+    'wheat': ['wheat', 'gehun', 'gahu', 'गेहूं', 'गेहूँ'],
+    'cotton': ['cotton', 'kapas', 'rui', 'कपास'],
+    'tomato': ['tomato', 'tamatar', 'टमाटर'],
+    'potato': ['potato', 'aloo', 'batata', 'आलू'],
+    'onion': ['onion', 'pyaj', 'kanda', 'प्याज'],
+    'sugarcane': ['sugarcane', 'ganna', 'ikhu', 'गन्ना'],
+    'maize': ['maize', 'corn', 'makka', 'bhutta', 'मक्का'],
+    'soybean': ['soybean', 'soya', 'bhatmas', 'सोयाबीन'],
+    'groundnut': ['groundnut', 'peanut', 'moongfali', 'मूंगफली'],
+    'banana': ['banana', 'kela', 'केला'],
+    'mango': ['mango', 'aam', 'आम'],
+    'chili': ['chili', 'pepper', 'mirch', 'lal mirch', 'मिर्च'],
+    'cabbage': ['cabbage', 'patta gobi', 'पत्ता गोभी'],
+    'cauliflower': ['cauliflower', 'phool gobi', 'फूल गोभी'],
+    'brinjal': ['brinjal', 'eggplant', 'baingan', 'बैंगन'],
+    'okra': ['okra', 'bhindi', 'lady finger', 'भिंडी']
+}
 
 def extract_crop_type_from_text(text: str) -> str:
     """Simple crop type extraction from text"""
     text_lower = text.lower()
     
-    # Common crop keywords in Hindi and English
-    crop_keywords = {
-        'rice': ['rice', 'chawal', 'dhan', 'paddy'],
-        'wheat': ['wheat', 'gehun', 'gahu'],
-        'cotton': ['cotton', 'kapas', 'rui'],
-        'tomato': ['tomato', 'tamatar'],
-        'potato': ['potato', 'aloo', 'batata'],
-        'onion': ['onion', 'pyaj', 'kanda'],
-        'sugarcane': ['sugarcane', 'ganna', 'ikhu'],
-        'maize': ['maize', 'corn', 'makka', 'bhutta'],
-        'soybean': ['soybean', 'soya', 'bhatmas'],
-        'groundnut': ['groundnut', 'peanut', 'moongfali'],
-        'banana': ['banana', 'kela'],
-        'mango': ['mango', 'aam'],
-        'chili': ['chili', 'pepper', 'mirch', 'lal mirch'],
-        'cabbage': ['cabbage', 'patta gobi'],
-        'cauliflower': ['cauliflower', 'phool gobi'],
-        'brinjal': ['brinjal', 'eggplant', 'baingan'],
-        'okra': ['okra', 'bhindi', 'lady finger']
-    }
-    
-    for crop, keywords in crop_keywords.items():
+    for crop, keywords in CROP_ALIASES.items():
         if any(keyword in text_lower for keyword in keywords):
             return crop
     
-    return ""
\ No newline at end of file
+    return ""
+
+def normalize_crop_name(crop: str) -> str:
+    """Map a crop name in any supported spelling (e.g. 'dhan', 'धान', 'Paddy') to its canonical name"""
+    crop_clean = " ".join(crop.lower().split())
+    for canonical, keywords in CROP_ALIASES.items():
+        if crop_clean == canonical or crop_clean in keywords:
+            return canonical
+    return extract_crop_type_from_text(crop_clean) or crop_clean
\ No newline at end of file
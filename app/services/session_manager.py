@@ -1,26 +1,106 @@
-from typing import Dict, List, Optional, Tuple
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
 from datetime import datetime, timedelta
+import asyncio
+import glob
+import gzip
+import heapq
+import json
+import os
 import threading
+import random
+import sys
 import time
-from dataclasses import dataclass
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from enum import Enum
+from app.config import settings
+from app.utils.tokens import count_tokens, MESSAGE_OVERHEAD_TOKENS
+from app.services.session_store import SessionStore, session_store, load_recent_history
+from app.utils.singleflight import SingleFlight
+
+# Rough per-object overheads for the memory budget (CPython 3.11, 64-bit)
+MESSAGE_BASE_BYTES = 400  # slotted object, timestamp, id, token count and cached OpenAI dict
+SESSION_BASE_BYTES = 1200  # session object, locks and lists
 
 class MessageType(Enum):
     USER = "user"
     ASSISTANT = "assistant"
     SYSTEM = "system"
 
-@dataclass
+@dataclass(slots=True)
 class Message:
-    """Represents a single message in the conversation"""
+    """Represents a single message in the conversation.
+
+    Slotted, with a float timestamp, since every session holds up to
+    MAX_CONVERSATION_HISTORY of these. The session caches each message's
+    OpenAI dict, which references the same content string.
+    """
     content: str
     message_type: MessageType
-    timestamp: datetime
-    image_base64: Optional[str] = None
+    timestamp: float = field(default_factory=time.time)  # epoch seconds, comparable across workers
+    image_base64: Optional[str] = None  # only kept while this is the current turn
+    image_ref: Optional[str] = None  # SHA-256 of the photo, kept for the whole session
+    image_mime_type: str = "image/jpeg"
+    message_id: int = field(default_factory=lambda: random.getrandbits(62))  # stable id in the shared store
+    token_count: int = field(default=0, init=False)  # cached prompt cost of to_openai_format()
+    
+    def __post_init__(self):
+        self.token_count = self.count_tokens()
+    
+    def drop_image(self) -> int:
+        """Release the image payload once its turn is over; returns the token delta"""
+        previous_tokens = self.token_count
+        self.image_base64 = None
+        self.token_count = self.count_tokens()
+        return self.token_count - previous_tokens
+    
+    def estimate_bytes(self) -> int:
+        """Approximate memory held by this message"""
+        size = MESSAGE_BASE_BYTES + sys.getsizeof(self.content)
+        if self.image_base64:
+            size += len(self.image_base64)
+        return size
+    
+    def to_dict(self) -> Dict:
+        """Session store record (the image payload is never shared)"""
+        return {
+            "id": self.message_id,
+            "role": self.message_type.value,
+            "content": self.content,
+            "timestamp": self.timestamp,
+            "image_ref": self.image_ref,
+            "image_mime_type": self.image_mime_type,
+        }
+    
+    @classmethod
+    def from_dict(cls, record: Dict) -> "Message":
+        return cls(
+            content=record["content"],
+            message_type=MessageType(record["role"]),
+            timestamp=record["timestamp"],
+            image_ref=record.get("image_ref"),
+            image_mime_type=record.get("image_mime_type", "image/jpeg"),
+            message_id=record["id"],
+        )
+    
+    def count_tokens(self) -> int:
+        """Prompt tokens this message costs when rendered for the model"""
+        if self.image_ref and not self.image_base64:
+            text = f"{self.content} [Earlier photo, ref {self.image_ref[:12]}]"
+        else:
+            text = self.content
+        tokens = count_tokens(text) + MESSAGE_OVERHEAD_TOKENS
+        if self.image_base64:
+            tokens += settings.IMAGE_TOKEN_ESTIMATE
+        return tokens
     
     def to_openai_format(self) -> Dict:
         """Convert message to OpenAI API format"""
         if self.message_type == MessageType.USER:
+            if self.image_ref and not self.image_base64:
+                # Earlier photo: a short text stand-in instead of re-uploading it,
+                # the diagnosis itself follows as the next assistant message
+                return {"role": "user", "content": f"{self.content} [Earlier photo, ref {self.image_ref[:12]}]"}
             if self.image_base64:
                 return {
                     "role": "user",
@@ -28,7 +108,7 @@ class Message:
                         {"type": "text", "text": self.content},
                         {
                             "type": "image_url",
-                            "image_url": {"url": f"data:image/jpeg;base64,{self.image_base64}"}
+                            "image_url": {"url": f"data:{self.image_mime_type};base64,{self.image_base64}"}
                         }
                     ]
                 }
@@ -42,46 +122,216 @@ class Message:
 class ConversationSession:
     """Manages a single user's conversation session"""
     
-    def __init__(self, user_id: str, max_messages: int = 30, session_timeout: int = 3600):
+    def __init__(self, user_id: str, max_messages: int = 30, session_timeout: int = 3600, max_tokens: int = 6000):
         self.user_id = user_id
         self.messages: List[Message] = []
         self.max_messages = max_messages
+        self.max_tokens = max_tokens  # history kept in memory, the per-call budget is applied on render
+        self.total_tokens = 0
+        self.summary = ""  # running summary of turns folded out of self.messages
+        self.summary_tokens = 0
+        self.summary_in_progress = False
         self.session_timeout = session_timeout  # in seconds (1 hour = 3600)
         self.last_activity = datetime.now()
+        self.last_active = time.monotonic()  # expiry clock; immune to wall-clock jumps
         self.created_at = datetime.now()
         self._lock = threading.Lock()
+        self._image_turn: Optional[Message] = None  # message still holding its image payload
+        # to_openai_format() of each message, kept in step with self.messages so
+        # building context renders nothing; None for a message holding a photo
+        self._rendered: List[Optional[Dict]] = []
+        self.store_revision: Optional[str] = None  # shared store revision this copy reflects
+        self._unsynced: List[Message] = []  # added locally, not yet appended to the store
+        self.total_bytes = SESSION_BASE_BYTES  # estimated memory footprint, see update_bytes()
+        self.removed = False  # evicted/expired/cleared from the manager
+        self.accounted_bytes = 0  # total_bytes as last counted in the manager's shard total
+        self.expiry_seq = 0  # this session's current entry in the manager's expiry heap
     
-    def add_message(self, content: str, message_type: MessageType, image_base64: Optional[str] = None):
+    def add_message(self, content: str, message_type: MessageType, image_base64: Optional[str] = None,
+                    image_ref: Optional[str] = None, image_mime_type: str = "image/jpeg"):
         """Add a message to the conversation"""
         with self._lock:
             message = Message(
                 content=content,
                 message_type=message_type,
-                timestamp=datetime.now(),
-                image_base64=image_base64
+                image_base64=image_base64,
+                image_ref=image_ref,
+                image_mime_type=image_mime_type
             )
             
+            # The previous image turn is over - drop its payload so later calls
+            # render only the text stand-in (and the memory is freed)
+            if self._image_turn is not None:
+                self.total_tokens += self._image_turn.drop_image()
+                self._rerender(self._image_turn)
+                self._image_turn = None
+            if image_base64:
+                self._image_turn = message
+            
             self.messages.append(message)
+            self._rendered.append(self._render(message))
+            self._unsynced.append(message)
+            self.total_tokens += message.token_count
             self.last_activity = datetime.now()
-            
-            # Implement FIFO: Remove oldest messages if limit exceeded
-            if len(self.messages) > self.max_messages:
-                # Keep system message if it's the first one
-                if self.messages[0].message_type == MessageType.SYSTEM:
-                    # Remove the second oldest message instead
-                    self.messages.pop(1)
-                else:
-                    # Remove the oldest message
-                    self.messages.pop(0)
+            self.last_active = time.monotonic()
+            self._trim()
+            self._update_bytes()
+    
+    @staticmethod
+    def _render(message: Message) -> Optional[Dict]:
+        # A photo's data URL would copy the whole payload - it is rendered per
+        # call for the one turn that still holds it
+        return None if message.image_base64 else message.to_openai_format()
+    
+    def _rerender(self, message: Message):
+        """Refresh one cached render (lock held); normally the latest message"""
+        for i in range(len(self.messages) - 1, -1, -1):
+            if self.messages[i] is message:
+                self._rendered[i] = self._render(message)
+                return
+    
+    def _rebuild_rendered(self):
+        """Re-render every message after a bulk change to self.messages (lock held)"""
+        self._rendered = [self._render(m) for m in self.messages]
+    
+    def _update_bytes(self):
+        # A few dozen messages at most, so a recount is cheaper than bookkeeping
+        self.total_bytes = (
+            SESSION_BASE_BYTES + sys.getsizeof(self.summary) + sum(m.estimate_bytes() for m in self.messages)
+        )
+    
+    @property
+    def has_unsynced(self) -> bool:
+        """A turn is in progress (or its messages haven't reached the store yet)"""
+        return bool(self._unsynced)
+    
+    def _trim(self):
+        """Drop the oldest messages while over the message or token limit (lock held)"""
+        # Implement FIFO, always keeping the latest turn
+        while len(self.messages) > 1 and (
+            len(self.messages) > self.max_messages or self.total_tokens > self.max_tokens
+        ):
+            # Keep system message if it's the first one
+            if self.messages[0].message_type == MessageType.SYSTEM:
+                if len(self.messages) == 2:
+                    break
+                # Remove the second oldest message instead
+                removed = self.messages.pop(1)
+                self._rendered.pop(1)
+            else:
+                # Remove the oldest message
+                removed = self.messages.pop(0)
+                self._rendered.pop(0)
+            self.total_tokens -= removed.token_count
+    
+    def get_messages_for_ai(self, token_budget: Optional[int] = None) -> List[Dict]:
+        """Get messages in OpenAI API format, newest first up to token_budget.
+
+        The latest message is always included, as is a leading system message.
+        Dicts come from the render cache, so only the list itself is new.
+        """
+        with self._lock:
+            if token_budget is None:
+                selected = range(len(self.messages))
+            else:
+                selected = []
+                used = 0
+                for i in range(len(self.messages) - 1, -1, -1):
+                    msg = self.messages[i]
+                    if msg.message_type == MessageType.SYSTEM:
+                        continue
+                    if selected and used + msg.token_count > token_budget:
+                        break
+                    selected.append(i)
+                    used += msg.token_count
+                selected.reverse()
+                
+                if self.messages and self.messages[0].message_type == MessageType.SYSTEM:
+                    selected.insert(0, 0)
+            return [self._rendered[i] or self.messages[i].to_openai_format() for i in selected]
+    
+    def replace_history(self, records: List[Dict], summary: str, revision: Optional[str]):
+        """Adopt the shared store's copy of the conversation (written by another worker)"""
+        with self._lock:
+            stored_ids = {record["id"] for record in records}
+            # Keep local messages that haven't reached the store yet
+            pending = [m for m in self._unsynced if m.message_id not in stored_ids]
+            self.messages = [Message.from_dict(record) for record in records] + pending
+            self.total_tokens = sum(m.token_count for m in self.messages)
+            self._image_turn = None
+            self.summary = summary
+            self.summary_tokens = count_tokens(summary) + MESSAGE_OVERHEAD_TOKENS if summary else 0
+            self.store_revision = revision
+            self._rebuild_rendered()
+            self._trim()
+            self._update_bytes()
+    
+    def take_unsynced(self) -> List[Message]:
+        """Hand over the messages still to be appended to the store"""
+        with self._lock:
+            pending, self._unsynced = self._unsynced, []
+            return pending
+    
+    def discard_unsynced(self):
+        """Drop the messages of an abandoned turn (it will be retried from scratch)"""
+        with self._lock:
+            discarded = {id(m) for m in self._unsynced}
+            self.messages = [m for m in self.messages if id(m) not in discarded]
+            self.total_tokens = sum(m.token_count for m in self.messages)
+            if self._image_turn is not None and id(self._image_turn) in discarded:
+                self._image_turn = None
+            self._unsynced = []
+            # Trimming may have dropped synced messages too - reload them next turn
+            self.store_revision = None
+            self._rebuild_rendered()
+            self._update_bytes()
+    
+    def needs_summary(self, trigger_tokens: int, keep_recent: int) -> bool:
+        """True when history has grown past the threshold and there is something to fold"""
+        return (
+            not self.summary_in_progress
+            and self.total_tokens > trigger_tokens
+            and len(self.messages) > keep_recent
+        )
+    
+    def messages_to_fold(self, keep_recent: int) -> List[Message]:
+        """Oldest messages to fold into the summary, leaving keep_recent verbatim"""
+        with self._lock:
+            foldable = [m for m in self.messages[:-keep_recent] if m.message_type != MessageType.SYSTEM]
+            # Never fold a turn whose photo is still being analysed
+            return [m for m in foldable if m is not self._image_turn]
     
-    def get_messages_for_ai(self) -> List[Dict]:
-        """Get messages in OpenAI API format"""
+    def apply_summary(self, summary: str, folded: List[Message]):
+        """Replace the folded messages with the new running summary"""
         with self._lock:
-            return [msg.to_openai_format() for msg in self.messages]
+            folded_ids = {id(m) for m in folded}
+            kept = [m for m in self.messages if id(m) not in folded_ids]
+            self.total_tokens -= sum(m.token_count for m in self.messages if id(m) in folded_ids)
+            self.messages = kept
+            self._rebuild_rendered()
+            self._unsynced = [m for m in self._unsynced if id(m) not in folded_ids]
+            self.summary = summary
+            self.summary_tokens = count_tokens(summary) + MESSAGE_OVERHEAD_TOKENS
+            self._update_bytes()
     
-    def is_expired(self) -> bool:
+    @property
+    def expires_at(self) -> float:
+        """Monotonic deadline after which the session is expired"""
+        return self.last_active + self.session_timeout
+    
+    def is_expired(self, now: Optional[float] = None) -> bool:
         """Check if session has expired"""
-        return datetime.now() - self.last_activity > timedelta(seconds=self.session_timeout)
+        return (now if now is not None else time.monotonic()) > self.expires_at
+    
+    def to_snapshot(self) -> Dict:
+        """Snapshot record (text only - image payloads are never written to disk)"""
+        with self._lock:
+            return {
+                "user_id": self.user_id,
+                "summary": self.summary,
+                "messages": [m.to_dict() for m in self.messages],
+                "last_activity": time.time() - (time.monotonic() - self.last_active),
+            }
     
     def get_session_info(self) -> Dict:
         """Get session information"""
@@ -89,144 +339,662 @@ class ConversationSession:
             return {
                 "user_id": self.user_id,
                 "message_count": len(self.messages),
+                "history_tokens": self.total_tokens,
+                "estimated_bytes": self.total_bytes,
+                "summary_tokens": self.summary_tokens,
                 "created_at": self.created_at.isoformat(),
                 "last_activity": self.last_activity.isoformat(),
                 "is_expired": self.is_expired(),
-                "time_remaining": max(0, self.session_timeout - (datetime.now() - self.last_activity).total_seconds())
+                "time_remaining": max(0, self.expires_at - time.monotonic())
             }
 
-class SessionManager:
-    """Manages all user sessions with automatic cleanup"""
+class CountingLock:
+    """A mutex with acquisition and contention counters"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.acquisitions = 0
+        self.contended = 0  # acquisitions that had to wait (or gave up) for another thread
+        self.wait_seconds = 0.0
+    
+    @contextmanager
+    def locked(self):
+        """Hold the lock, counting acquisitions that had to wait"""
+        if not self._lock.acquire(blocking=False):
+            started = time.perf_counter()
+            self._lock.acquire()
+            self.contended += 1
+            self.wait_seconds += time.perf_counter() - started
+        self.acquisitions += 1
+        try:
+            yield
+        finally:
+            self._lock.release()
+    
+    def try_acquire(self) -> bool:
+        """Take the lock only if it is free; a miss counts as contended"""
+        if not self._lock.acquire(blocking=False):
+            self.contended += 1
+            return False
+        self.acquisitions += 1
+        return True
+    
+    def release(self):
+        self._lock.release()
+
+def _pid_alive(pid: int) -> bool:
+    """Whether a process with this pid is running (assumed so where it can't be checked)"""
+    if os.name != "posix":
+        return True  # os.kill(pid, 0) would terminate it on Windows
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # running under another user
+    return True
+
+class SessionShard(CountingLock):
+    """One stripe of the session map.
+
+    The shard lock guards its sessions, its share of the memory estimate and
+    its expiry heap, so no bookkeeping is shared between shards.
+    """
     
-    def __init__(self, max_messages_per_session: int = 30, session_timeout: int = 3600, cleanup_interval: int = 300):
+    def __init__(self):
+        super().__init__()
         self.sessions: Dict[str, ConversationSession] = {}
+        self.memory_bytes = 0
+        self.expiry_heap: List[Tuple[float, int, str]] = []  # (deadline, seq, user_id)
+        self.expiry_seq = 0  # identifies an entry; matched against session.expiry_seq
+
+class SessionManager:
+    """Manages all user sessions with automatic cleanup.
+    
+    Sessions are striped across shards by user id so concurrent users rarely
+    share a lock. Reads of an existing session are lock-free (a single dict
+    lookup is atomic); locks are only taken to create, replace or remove one,
+    or to update the shard's byte total and expiry heap. Manager-wide figures
+    are sums over the shards, taken on read.
+    
+    Expiry is tracked in per-shard min-heaps of monotonic deadlines with one
+    entry per session. Activity doesn't touch the heap; when an entry comes due for a
+    session that was active since, it is pushed back with the new deadline.
+    A cleanup pass therefore only visits sessions whose deadline has passed.
+    Entries hold the user id, not the session, so an evicted or cleared
+    session is freed right away; its entry is skipped when it comes due.
+    
+    Each worker's sessions are a local working copy of the shared session
+    store: a turn starts with refresh_session() and ends with flush_session().
+    
+    Memory is capped by memory_budget (estimated bytes across all sessions,
+    plus the in-process memory store's copy of them). Going over it evicts the
+    least recently active sessions down to the low water mark. Their history
+    is already in the shared store, so an evicted farmer's next turn simply
+    reloads it. The in-process store's copy is evicted (and expired) along
+    with the session, so that farmer is rehydrated from the message log instead.
+    
+    When neither this worker nor the store knows a user (restart, store
+    expiry, first contact on this deployment), the session is rehydrated from
+    the message log via history_loader - one indexed query, shared by
+    concurrent misses for the same user.
+    """
+    
+    def __init__(self, max_messages_per_session: int = 30, session_timeout: int = 3600, cleanup_interval: int = 300,
+                 max_tokens_per_session: int = 6000, num_shards: int = 16, store: Optional[SessionStore] = None,
+                 memory_budget: int = 256 * 1024 * 1024, memory_low_water: float = 0.9,
+                 history_loader: Optional[Callable[[str, int, datetime], Awaitable[List[Dict]]]] = None):
+        self.shards: List[SessionShard] = [SessionShard() for _ in range(max(num_shards, 1))]
         self.max_messages_per_session = max_messages_per_session
+        self.max_tokens_per_session = max_tokens_per_session
         self.session_timeout = session_timeout
-        self.cleanup_interval = cleanup_interval  # cleanup every 5 minutes
-        self._lock = threading.Lock()
-        
-        # Start cleanup thread
-        self._cleanup_thread = threading.Thread(target=self._cleanup_expired_sessions, daemon=True)
-        self._cleanup_thread.start()
+        self.cleanup_interval = cleanup_interval  # upper bound between cleanup passes
+        self.store = store
+        self.memory_budget = memory_budget
+        self.memory_low_water = memory_low_water  # evict down to this fraction of the budget
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self._evict_lock = CountingLock()  # only tried when over budget, never waited on
+        self.history_loader = history_loader
+        self._rehydrate_flight = SingleFlight()
+        self.rehydrated = 0
         
-        print(f"[SESSION_MANAGER] Started with {max_messages_per_session} max messages, {session_timeout/60:.1f}min timeout")
+        print(f"[SESSION_MANAGER] Started with {max_messages_per_session} max messages, {session_timeout/60:.1f}min timeout, "
+              f"{len(self.shards)} shards")
+    
+    def _shard(self, user_id: str) -> SessionShard:
+        return self.shards[hash(user_id) % len(self.shards)]
+    
+    @property
+    def memory_bytes(self) -> int:
+        """Estimated bytes held by all sessions"""
+        return sum(shard.memory_bytes for shard in self.shards)
+    
+    @property
+    def used_bytes(self) -> int:
+        """Bytes counted against the budget: sessions plus an in-process store's copy"""
+        store_bytes = self.store.memory_bytes if self.store is not None else 0
+        return self.memory_bytes + store_bytes
+    
+    def _snapshot(self) -> List[Tuple[str, ConversationSession]]:
+        """Copy every shard's entries, holding one shard lock at a time"""
+        items: List[Tuple[str, ConversationSession]] = []
+        for shard in self.shards:
+            with shard.locked():
+                items.extend(shard.sessions.items())
+        return items
     
     def get_or_create_session(self, user_id: str) -> ConversationSession:
         """Get existing session or create new one"""
-        with self._lock:
+        shard = self._shard(user_id)
+        
+        # Fast path: live session, no lock
+        session = shard.sessions.get(user_id)
+        if session is not None and not session.is_expired():
+            return session
+        
+        with shard.locked():
             # Check if session exists and is not expired
-            if user_id in self.sessions:
-                session = self.sessions[user_id]
+            session = shard.sessions.get(user_id)
+            if session is not None:
                 if not session.is_expired():
                     return session
                 else:
                     # Session expired, remove it
-                    del self.sessions[user_id]
+                    self._remove_locked(shard, user_id)
                     print(f"[SESSION_MANAGER] Expired session removed for user: {user_id}")
             
             # Create new session
             session = ConversationSession(
                 user_id=user_id,
                 max_messages=self.max_messages_per_session,
-                session_timeout=self.session_timeout
+                session_timeout=self.session_timeout,
+                max_tokens=self.max_tokens_per_session
             )
-            self.sessions[user_id] = session
+            self._insert_locked(shard, session)
             print(f"[SESSION_MANAGER] New session created for user: {user_id}")
             return session
     
-    def add_message(self, user_id: str, content: str, message_type: MessageType, image_base64: Optional[str] = None):
+    def _insert_locked(self, shard: SessionShard, session: ConversationSession):
+        """Add a session to its shard and schedule its expiry (shard lock held)"""
+        shard.sessions[session.user_id] = session
+        session.accounted_bytes = session.total_bytes
+        shard.memory_bytes += session.accounted_bytes
+        self._schedule_expiry(shard, session.user_id, session)
+    
+    def _track(self, session: ConversationSession):
+        """Account for a session's size change, then enforce the budget"""
+        if session.total_bytes != session.accounted_bytes:
+            shard = self._shard(session.user_id)
+            with shard.locked():
+                if session.removed:
+                    return
+                shard.memory_bytes += session.total_bytes - session.accounted_bytes
+                session.accounted_bytes = session.total_bytes
+        if self.used_bytes > self.memory_budget:
+            self._evict(keep=session)
+    
+    def _remove_locked(self, shard: SessionShard, user_id: str) -> ConversationSession:
+        """Drop a session from its shard (shard lock held)"""
+        session = shard.sessions.pop(user_id)
+        session.removed = True
+        shard.memory_bytes -= session.accounted_bytes
+        return session
+    
+    def _evict(self, keep: ConversationSession):
+        """Evict least recently active sessions until under the low water mark"""
+        if not self._evict_lock.try_acquire():
+            return  # another thread is already evicting
+        try:
+            excess = self.used_bytes - int(self.memory_budget * self.memory_low_water)
+            if excess <= 0:
+                return
+            # Skip sessions mid-turn: their messages aren't in the shared store yet
+            candidates = [
+                (session.last_active, user_id, session)
+                for user_id, session in self._snapshot()
+                if session is not keep and not session.has_unsynced
+            ]
+            freed = evicted = 0
+            for _, user_id, session in sorted(candidates, key=lambda c: c[0]):
+                if freed >= excess:
+                    break
+                shard = self._shard(user_id)
+                with shard.locked():
+                    if shard.sessions.get(user_id) is not session:
+                        continue
+                    self._remove_locked(shard, user_id)
+                freed += session.accounted_bytes
+                if self.store is not None:
+                    freed += self.store.evict(user_id)
+                evicted += 1
+            self.evictions += evicted
+            self.evicted_bytes += freed
+            print(f"[SESSION_MANAGER] Memory budget exceeded: evicted {evicted} sessions ({freed / 1024:.0f} KiB)")
+        finally:
+            self._evict_lock.release()
+    
+    def _schedule_expiry(self, shard: SessionShard, user_id: str, session: ConversationSession):
+        """Push the session's deadline onto its shard's heap (shard lock held)"""
+        shard.expiry_seq += 1
+        session.expiry_seq = shard.expiry_seq
+        heapq.heappush(shard.expiry_heap, (session.expires_at, shard.expiry_seq, user_id))
+    
+    def add_message(self, user_id: str, content: str, message_type: MessageType, image_base64: Optional[str] = None,
+                    image_ref: Optional[str] = None, image_mime_type: str = "image/jpeg"):
         """Add message to user's session"""
         session = self.get_or_create_session(user_id)
-        session.add_message(content, message_type, image_base64)
+        session.add_message(content, message_type, image_base64, image_ref, image_mime_type)
+        self._track(session)
         print(f"[SESSION_MANAGER] Message added for {user_id}: {message_type.value} ({len(session.messages)} total)")
     
-    def get_conversation_context(self, user_id: str, system_prompt: str) -> List[Dict]:
-        """Get full conversation context for AI, including system prompt"""
+    def get_conversation_context(self, user_id: str, system_prompt: str, call_type: Optional[str] = None) -> List[Dict]:
+        """Get conversation context for AI, including system prompt, within the call type's token budget"""
         session = self.get_or_create_session(user_id)
-        messages = session.get_messages_for_ai()
+        token_budget = settings.CONTEXT_TOKEN_BUDGETS.get(call_type, settings.MAX_TOKENS) if call_type else None
+        summary = session.summary
+        if summary and token_budget is not None:
+            token_budget = max(token_budget - session.summary_tokens, 0)
+        messages = session.get_messages_for_ai(token_budget)
         
         # Always ensure system message is first
         if not messages or messages[0].get("role") != "system":
             messages.insert(0, {"role": "system", "content": system_prompt})
         
+        # Earlier turns that were folded into the running summary
+        if summary:
+            messages.insert(1, {"role": "system", "content": f"Summary of the earlier conversation with this farmer:\n{summary}"})
+        
         return messages
     
+    async def refresh_session(self, user_id: str) -> ConversationSession:
+        """Bring the local copy up to date with the shared store (start of a turn)"""
+        session = self.get_or_create_session(user_id)
+        if self.store is None:
+            return session
+        try:
+            doc = await self.store.load(user_id)
+        except Exception as e:
+            print(f"[SESSION_MANAGER] Could not load shared session for {user_id}, using local copy: {e}")
+            return session
+        if doc is None:
+            if session.store_revision is not None:
+                # Cleared or expired in the store since we last synced
+                session.replace_history([], "", None)
+            elif not session.messages and self.history_loader is not None:
+                await self._rehydrate(user_id, session)
+        elif doc.get("revision") != session.store_revision:
+            session.replace_history(doc.get("messages", []), doc.get("summary", ""), doc.get("revision"))
+            print(f"[SESSION_MANAGER] Loaded shared session for {user_id} ({len(session.messages)} messages)")
+        self._track(session)
+        return session
+    
+    async def _rehydrate(self, user_id: str, session: ConversationSession):
+        """Rebuild an empty session from the message log and publish it to the store"""
+        assert self.history_loader is not None
+        # Only turns within the session timeout - an idle farmer still starts fresh
+        since = datetime.now() - timedelta(seconds=self.session_timeout)
+        try:
+            records = await self._rehydrate_flight.do(
+                user_id, lambda: self.history_loader(user_id, self.max_messages_per_session * 2, since)
+            )
+        except Exception as e:
+            print(f"[SESSION_MANAGER] Could not rehydrate session for {user_id}: {e}")
+            return
+        if not records or session.messages:
+            return  # nothing logged, or a concurrent refresh already filled it
+        
+        session.replace_history(records, "", None)
+        self.rehydrated += 1
+        print(f"[SESSION_MANAGER] Rehydrated {len(session.messages)} messages for {user_id} from the message log")
+        if self.store is not None:
+            try:
+                # Insert-if-absent: another worker may have seeded it first
+                session.store_revision = await self.store.seed(user_id, [m.to_dict() for m in session.messages])
+            except Exception as e:
+                print(f"[SESSION_MANAGER] Could not seed shared session for {user_id}: {e}")
+    
+    async def flush_session(self, user_id: str):
+        """Append this turn's messages to the shared store (end of a turn)"""
+        session = self.get_session(user_id)
+        if self.store is None or session is None:
+            return
+        pending = session.take_unsynced()
+        if not pending:
+            return
+        expected = session.store_revision
+        try:
+            previous, revision = await self.store.append(
+                user_id, [m.to_dict() for m in pending], self.max_messages_per_session
+            )
+        except Exception as e:
+            print(f"[SESSION_MANAGER] Could not save shared session for {user_id}: {e}")
+            return
+        # Another worker wrote in between - reload on the next turn
+        session.store_revision = revision if previous == expected else None
+    
+    def discard_turn(self, user_id: str):
+        """Undo a turn that failed before the farmer got a reply"""
+        session = self.get_session(user_id)
+        if session is None:
+            return
+        session.discard_unsynced()
+        self._track(session)
+    
+    async def store_summary(self, user_id: str, summary: str, folded: List[Message]):
+        """Apply a rolling summary locally and in the shared store"""
+        session = self.get_session(user_id)
+        if session is None:
+            return
+        session.apply_summary(summary, folded)
+        self._track(session)
+        if self.store is None:
+            return
+        expected = session.store_revision
+        previous, revision = await self.store.fold(user_id, summary, [m.message_id for m in folded])
+        session.store_revision = revision if previous == expected else None
+    
+    async def clear_shared_session(self, user_id: str) -> bool:
+        """Clear a user's session locally and in the shared store"""
+        cleared = self.clear_session(user_id)
+        if self.store is not None:
+            cleared = await self.store.clear(user_id) or cleared
+        return cleared
+    
+    def get_session(self, user_id: str) -> Optional[ConversationSession]:
+        """Get a user's session without creating one"""
+        return self._shard(user_id).sessions.get(user_id)
+    
     def get_session_info(self, user_id: str) -> Optional[Dict]:
         """Get session information for a user"""
-        with self._lock:
-            if user_id in self.sessions:
-                return self.sessions[user_id].get_session_info()
-            return None
+        session = self.get_session(user_id)
+        if session is not None:
+            return session.get_session_info()
+        return None
     
     def clear_session(self, user_id: str) -> bool:
         """Manually clear a user's session"""
-        with self._lock:
-            if user_id in self.sessions:
-                del self.sessions[user_id]
+        shard = self._shard(user_id)
+        with shard.locked():
+            if user_id in shard.sessions:
+                self._remove_locked(shard, user_id)
                 print(f"[SESSION_MANAGER] Session manually cleared for user: {user_id}")
                 return True
             return False
     
     def get_active_sessions_count(self) -> int:
         """Get count of active sessions"""
-        with self._lock:
-            return len(self.sessions)
+        return sum(len(shard.sessions) for shard in self.shards)
+    
+    def get_lock_stats(self) -> Dict:
+        """Get acquisition and contention counters across every manager lock"""
+        locks: List[CountingLock] = [*self.shards, self._evict_lock]
+        acquisitions = sum(lock.acquisitions for lock in locks)
+        contended = sum(lock.contended for lock in locks)
+        return {
+            "shards": len(self.shards),
+            "acquisitions": acquisitions,
+            "contended": contended,
+            "contention_rate": round(contended / acquisitions, 4) if acquisitions else 0.0,
+            "wait_ms": round(sum(lock.wait_seconds for lock in locks) * 1000, 2),
+            "max_shard_size": max(len(shard.sessions) for shard in self.shards),
+            "evict_lock": {
+                "acquisitions": self._evict_lock.acquisitions,
+                "contended": self._evict_lock.contended,
+            },
+        }
+    
+    def get_memory_stats(self) -> Dict:
+        """Get estimated session memory against the budget, and eviction counters.
+
+        used_bytes includes an in-process store's copy of the history;
+        session_bytes is the sessions alone.
+        """
+        used = self.used_bytes
+        return {
+            "budget_bytes": self.memory_budget,
+            "used_bytes": used,
+            "session_bytes": self.memory_bytes,
+            "utilization": round(used / self.memory_budget, 4) if self.memory_budget else 0.0,
+            "evictions": self.evictions,
+            "evicted_bytes": self.evicted_bytes,
+            "store": self.store.get_stats() if self.store is not None else None,
+        }
     
     def get_all_sessions_info(self) -> Dict:
         """Get information about all active sessions"""
-        with self._lock:
-            return {
-                "active_sessions": len(self.sessions),
-                "sessions": {
-                    user_id: session.get_session_info() 
-                    for user_id, session in self.sessions.items()
-                }
-            }
+        # Per-session info is built outside the shard locks
+        sessions = self._snapshot()
+        return {
+            "active_sessions": len(sessions),
+            "sessions": {
+                user_id: session.get_session_info() 
+                for user_id, session in sessions
+            },
+            "locks": self.get_lock_stats(),
+            "memory": self.get_memory_stats(),
+            "rehydrated": self.rehydrated,
+        }
+    
+    def next_expiry(self) -> Optional[float]:
+        """Earliest scheduled deadline (may belong to a session active since)"""
+        deadlines = []
+        for shard in self.shards:
+            with shard.locked():
+                if shard.expiry_heap:
+                    deadlines.append(shard.expiry_heap[0][0])
+        return min(deadlines, default=None)
+    
+    def expire_sessions(self, now: Optional[float] = None) -> int:
+        """Remove sessions whose deadline has passed; returns how many were removed"""
+        now = now if now is not None else time.monotonic()
+        expired: List[str] = []
+        # One shard at a time, so cleanup never blocks more than one stripe
+        for shard in self.shards:
+            with shard.locked():
+                while shard.expiry_heap and shard.expiry_heap[0][0] < now:
+                    _, seq, user_id = heapq.heappop(shard.expiry_heap)
+                    session = shard.sessions.get(user_id)
+                    if session is None or session.expiry_seq != seq:
+                        continue  # evicted, cleared or replaced - stale entry
+                    if session.is_expired(now):
+                        self._remove_locked(shard, user_id)
+                        expired.append(user_id)
+                        print(f"[SESSION_MANAGER] Expired session cleaned up for user: {user_id}")
+                        continue
+                    # Active since it was scheduled - push back with its new deadline
+                    self._schedule_expiry(shard, user_id, session)
+        
+        if expired:
+            # Those conversations are over - free an in-process store's copy too, not just on its next access
+            if self.store is not None:
+                for user_id in expired:
+                    self.store.evict(user_id)
+            print(f"[SESSION_MANAGER] Cleaned up {len(expired)} expired sessions")
+        return len(expired)
+    
+    def restore_session(self, record: Dict) -> Optional[ConversationSession]:
+        """Re-create a session from a snapshot record unless it has expired meanwhile"""
+        idle = max(time.time() - record["last_activity"], 0.0)
+        if idle >= self.session_timeout:
+            return None
+        session = ConversationSession(
+            user_id=record["user_id"],
+            max_messages=self.max_messages_per_session,
+            session_timeout=self.session_timeout,
+            max_tokens=self.max_tokens_per_session
+        )
+        session.replace_history(record["messages"], record.get("summary", ""), None)
+        session.last_active = time.monotonic() - idle
+        session.last_activity = datetime.fromtimestamp(record["last_activity"])
+        
+        shard = self._shard(session.user_id)
+        with shard.locked():
+            if session.user_id in shard.sessions:
+                return None  # already active again
+            self._insert_locked(shard, session)
+        return session
+    
+    @staticmethod
+    def snapshot_file(path: str) -> str:
+        """This process's snapshot file - every app worker writes its own"""
+        return f"{path}.{os.getpid()}"
+    
+    def save_snapshot(self, path: str) -> int:
+        """Write all sessions to a gzipped JSON-lines file; returns the session count"""
+        records = [session.to_snapshot() for _, session in self._snapshot()]
+        path = self.snapshot_file(path)
+        tmp_path = f"{path}.tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")))
+                f.write("\n")
+        # Atomic swap, so a crash mid-write never leaves a truncated snapshot
+        os.replace(tmp_path, path)
+        return len(records)
     
-    def _cleanup_expired_sessions(self):
-        """Background thread to cleanup expired sessions"""
+    @staticmethod
+    def read_snapshots(path: str) -> Tuple[List[Dict], List[str]]:
+        """Read the snapshot records of workers that are gone, newest activity first.
+
+        Returns (records, files), where files are the ones to consume - including
+        temp files a crash left behind, which are never read. Files of live
+        sibling workers (e.g. during a rolling restart) are left alone.
+        """
+        prefix = f"{path}."
+        files: List[str] = []
+        records: List[Dict] = []
+        for file in glob.glob(f"{glob.escape(path)}.*"):
+            suffix = file[len(prefix):]
+            temp = suffix.endswith(".tmp")
+            pid = suffix[:-len(".tmp")] if temp else suffix
+            if not pid.isdigit() or int(pid) <= 0:
+                continue  # not a snapshot file
+            if int(pid) != os.getpid() and _pid_alive(int(pid)):
+                continue  # a running sibling worker's file
+            files.append(file)
+            if temp:
+                continue
+            try:
+                with gzip.open(file, "rt", encoding="utf-8") as f:
+                    records.extend(json.loads(line) for line in f if line.strip())
+            except FileNotFoundError:
+                continue  # removed by another worker restoring at the same time
+        # A user can appear in several workers' files - the newest copy wins
+        records.sort(key=lambda record: record["last_activity"], reverse=True)
+        return records, files
+    
+    async def run_snapshots(self, path: str, interval: float):
+        """Snapshot sessions every interval seconds, until cancelled"""
         while True:
+            await asyncio.sleep(interval)
             try:
-                time.sleep(self.cleanup_interval)
-                expired_users = []
-                
-                with self._lock:
-                    for user_id, session in self.sessions.items():
-                        if session.is_expired():
-                            expired_users.append(user_id)
-                
-                # Remove expired sessions
-                for user_id in expired_users:
-                    with self._lock:
-                        if user_id in self.sessions:
-                            del self.sessions[user_id]
-                            print(f"[SESSION_MANAGER] Expired session cleaned up for user: {user_id}")
-                
-                if expired_users:
-                    print(f"[SESSION_MANAGER] Cleaned up {len(expired_users)} expired sessions")
-                    
+                await asyncio.to_thread(self.save_snapshot, path)
+            except Exception as e:
+                print(f"[SESSION_MANAGER] Snapshot error: {e}")
+    
+    async def run_cleanup(self):
+        """Expire sessions as their deadlines come due, until cancelled"""
+        while True:
+            next_expiry = self.next_expiry()
+            delay = self.cleanup_interval
+            if next_expiry is not None:
+                delay = min(max(next_expiry - time.monotonic(), 1.0), self.cleanup_interval)
+            await asyncio.sleep(delay)
+            try:
+                self.expire_sessions()
             except Exception as e:
                 print(f"[SESSION_MANAGER] Cleanup error: {e}")
 
 # Global session manager instance
 session_manager = SessionManager(
-    max_messages_per_session=30,
-    session_timeout=3600,  # 1 hour
-    cleanup_interval=300   # cleanup every 5 minutes
+    max_messages_per_session=settings.MAX_CONVERSATION_HISTORY,
+    session_timeout=settings.SESSION_TIMEOUT_SECONDS,
+    cleanup_interval=300,  # check at least every 5 minutes
+    max_tokens_per_session=settings.MAX_TOKENS,
+    num_shards=settings.SESSION_SHARDS,
+    store=session_store,
+    memory_budget=settings.SESSION_MEMORY_BUDGET_BYTES,
+    memory_low_water=settings.SESSION_MEMORY_LOW_WATER,
+    history_loader=load_recent_history
 )
 
+_cleanup_task: Optional[asyncio.Task] = None
+_snapshot_task: Optional[asyncio.Task] = None
+
+async def restore_session_snapshot():
+    """Warm restart: reload sessions from the last snapshot (called on app startup)"""
+    path = settings.SESSION_SNAPSHOT_PATH
+    if not path:
+        return
+    try:
+        records, files = await asyncio.to_thread(SessionManager.read_snapshots, path)
+    except Exception as e:
+        print(f"[SESSION_MANAGER] Could not read session snapshot {path}: {e}")
+        return
+    
+    restored = 0
+    for record in records:
+        session = session_manager.restore_session(record)
+        if session is None:
+            continue
+        restored += 1
+        # Seed the shared store when it lost the session too (memory backend);
+        # otherwise the store's copy wins on the next refresh
+        store = session_manager.store
+        if store is not None:
+            try:
+                session.store_revision = await store.seed(session.user_id, record["messages"], session.summary)
+            except Exception as e:
+                print(f"[SESSION_MANAGER] Could not seed shared session for {session.user_id}: {e}")
+    print(f"[SESSION_MANAGER] Restored {restored} of {len(records)} sessions from {path}.*")
+    
+    # Files of exited workers are consumed; this process writes its own
+    for file in files:
+        try:
+            os.remove(file)
+        except OSError:
+            pass
+
+def start_session_cleanup():
+    """Start the expiry and snapshot tasks (called on app startup)"""
+    global _cleanup_task, _snapshot_task
+    if _cleanup_task is None:
+        _cleanup_task = asyncio.create_task(session_manager.run_cleanup())
+    if _snapshot_task is None and settings.SESSION_SNAPSHOT_PATH and settings.SESSION_SNAPSHOT_INTERVAL_SECONDS > 0:
+        _snapshot_task = asyncio.create_task(
+            session_manager.run_snapshots(settings.SESSION_SNAPSHOT_PATH, settings.SESSION_SNAPSHOT_INTERVAL_SECONDS)
+        )
+
+async def stop_session_cleanup():
+    """Cancel the background tasks and write a final snapshot (called on app shutdown)"""
+    global _cleanup_task, _snapshot_task
+    for task in (_cleanup_task, _snapshot_task):
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+    _cleanup_task = _snapshot_task = None
+    
+    if settings.SESSION_SNAPSHOT_PATH:
+        try:
+            count = await asyncio.to_thread(session_manager.save_snapshot, settings.SESSION_SNAPSHOT_PATH)
+            print(f"[SESSION_MANAGER] Saved {count} sessions to {SessionManager.snapshot_file(settings.SESSION_SNAPSHOT_PATH)}")
+        except Exception as e:
+            print(f"[SESSION_MANAGER] Could not save session snapshot: {e}")
+
 # Utility functions for easy integration
-def add_user_message(user_id: str, content: str, image_base64: Optional[str] = None):
+def add_user_message(user_id: str, content: str, image_base64: Optional[str] = None, image_ref: Optional[str] = None,
+                     image_mime_type: str = "image/jpeg"):
     """Add user message to session"""
-    session_manager.add_message(user_id, content, MessageType.USER, image_base64)
+    session_manager.add_message(user_id, content, MessageType.USER, image_base64, image_ref, image_mime_type)
 
 def add_assistant_message(user_id: str, content: str):
     """Add assistant message to session"""
     session_manager.add_message(user_id, content, MessageType.ASSISTANT)
 
-def get_conversation_history(user_id: str, system_prompt: str) -> List[Dict]:
-    """Get conversation history for AI model"""
-    return session_manager.get_conversation_context(user_id, system_prompt)
+def get_conversation_history(user_id: str, system_prompt: str, call_type: Optional[str] = None) -> List[Dict]:
+    """Get conversation history for AI model (trimmed to the call type's token budget)"""
+    return session_manager.get_conversation_context(user_id, system_prompt, call_type)
 
 def clear_user_session(user_id: str) -> bool:
     """Clear user's session"""
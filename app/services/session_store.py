@@ -0,0 +1,250 @@
+import sys
+import threading
+import uuid
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from app.config import settings
+from app.utils.cache import TTLCache
+
+STORE_DOC_BYTES = 300  # document dict, message list and revision
+STORE_RECORD_BYTES = 350  # one message record: dict, id and timestamp
+
+class SessionStore(ABC):
+    """Conversation history shared between workers, so any worker can pick up
+    a farmer's follow-up.
+
+    A session document is ``{"messages": [...], "summary": str, "revision": str}``
+    where messages are ``Message.to_dict()`` records (text only - photo payloads
+    never leave the worker that analysed them). Every write sets a fresh
+    revision and returns ``(previous_revision, new_revision)``, so a worker can
+    tell whether anyone else wrote since it last synced.
+    """
+
+    async def setup(self):
+        """Create indexes; called once on startup"""
+
+    def get_stats(self) -> Dict:
+        return {"backend": type(self).__name__, "in_process": False}
+
+    @property
+    def memory_bytes(self) -> int:
+        """Estimated bytes this store holds in the worker's own memory"""
+        return 0
+
+    def evict(self, user_id: str) -> int:
+        """Drop an in-process copy to free memory; returns the bytes freed.
+
+        A store outside the worker keeps its copy - that is what lets an
+        evicted session be reloaded.
+        """
+        return 0
+
+    @abstractmethod
+    async def load(self, user_id: str) -> Optional[Dict]:
+        ...
+
+    @abstractmethod
+    async def append(self, user_id: str, messages: List[Dict], max_messages: int) -> Tuple[Optional[str], str]:
+        """Atomically append messages and keep only the newest max_messages"""
+
+    @abstractmethod
+    async def seed(self, user_id: str, messages: List[Dict], summary: str = "") -> Optional[str]:
+        """Create the session only if it doesn't exist; returns its revision, or None if it did"""
+
+    @abstractmethod
+    async def fold(self, user_id: str, summary: str, message_ids: List[int]) -> Tuple[Optional[str], str]:
+        """Atomically drop the summarized messages and store the new summary"""
+
+    @abstractmethod
+    async def clear(self, user_id: str) -> bool:
+        """Reset to an empty session; returns whether one existed.
+
+        The empty document stays until it expires, so a cleared conversation
+        isn't rehydrated from the message log.
+        """
+
+class MemorySessionStore(SessionStore):
+    """In-process store for single-worker deployments and local development.
+
+    Writes never await, so each one is atomic on the event loop. Stored lists
+    are replaced rather than mutated, so a loaded document is a stable snapshot.
+
+    Its documents live in the worker's memory next to the sessions, so the
+    session manager counts memory_bytes against its budget and evicts from
+    here along with the session.
+    """
+
+    def __init__(self, max_sessions: int, ttl: float):
+        self._docs = TTLCache(max_size=max_sessions, ttl=ttl, on_remove=self._forget)
+        self._bytes_lock = threading.Lock()
+        self._memory_bytes = 0
+
+    def get_stats(self) -> Dict:
+        return {
+            "backend": type(self).__name__,
+            "in_process": True,
+            "sessions": len(self._docs),
+            "memory_bytes": self._memory_bytes,
+        }
+
+    @property
+    def memory_bytes(self) -> int:
+        return self._memory_bytes
+
+    def evict(self, user_id: str) -> int:
+        doc = self._docs.get(user_id)
+        if doc is None or not self._docs.invalidate(user_id):
+            return 0
+        return doc["bytes"]
+
+    def _forget(self, user_id: str, doc: Dict):
+        # Called by the cache whenever a document is replaced or dropped
+        with self._bytes_lock:
+            self._memory_bytes -= doc["bytes"]
+
+    async def load(self, user_id: str) -> Optional[Dict]:
+        return self._docs.get(user_id)
+
+    def _write(self, user_id: str, messages: List[Dict], summary: Optional[str] = None) -> Tuple[Optional[str], str]:
+        doc = self._docs.get(user_id) or {"messages": [], "summary": "", "revision": None}
+        revision = uuid.uuid4().hex
+        summary = doc["summary"] if summary is None else summary
+        # Message text is counted too, although it is usually shared with the session's copy
+        size = (
+            STORE_DOC_BYTES + sys.getsizeof(summary)
+            + sum(STORE_RECORD_BYTES + sys.getsizeof(m["content"]) for m in messages)
+        )
+        with self._bytes_lock:
+            self._memory_bytes += size
+        self._docs.set(user_id, {"messages": messages, "summary": summary, "revision": revision, "bytes": size})
+        return doc["revision"], revision
+
+    async def append(self, user_id: str, messages: List[Dict], max_messages: int) -> Tuple[Optional[str], str]:
+        doc = self._docs.get(user_id)
+        existing = doc["messages"] if doc else []
+        return self._write(user_id, (existing + messages)[-max_messages:])
+
+    async def seed(self, user_id: str, messages: List[Dict], summary: str = "") -> Optional[str]:
+        if self._docs.get(user_id) is not None:
+            return None
+        return self._write(user_id, messages, summary)[1]
+
+    async def fold(self, user_id: str, summary: str, message_ids: List[int]) -> Tuple[Optional[str], str]:
+        doc = self._docs.get(user_id)
+        folded = set(message_ids)
+        kept = [m for m in doc["messages"] if m["id"] not in folded] if doc else []
+        return self._write(user_id, kept, summary)
+
+    async def clear(self, user_id: str) -> bool:
+        existed = self._docs.get(user_id) is not None
+        self._write(user_id, [], "")
+        return existed
+
+class MongoSessionStore(SessionStore):
+    """Sessions on the shared MongoDB database (``sessions`` collection).
+
+    Appends use ``$push`` with ``$each``/``$slice`` and folds use ``$pull``, so
+    concurrent writers never lose each other's messages. Idle sessions expire
+    through a TTL index on ``updated_at``.
+    """
+
+    def __init__(self):
+        from app.services.mongo_db import db
+        self.collection = db["sessions"]
+
+    async def setup(self):
+        await self.collection.create_index("updated_at", expireAfterSeconds=settings.SESSION_TIMEOUT_SECONDS)
+
+    async def load(self, user_id: str) -> Optional[Dict]:
+        return await self.collection.find_one({"_id": user_id}, {"messages": 1, "summary": 1, "revision": 1})
+
+    async def _update(self, user_id: str, update: Dict, upsert: bool = False) -> Tuple[Optional[str], str]:
+        revision = uuid.uuid4().hex
+        update.setdefault("$set", {}).update({"revision": revision, "updated_at": datetime.now()})
+        previous = await self.collection.find_one_and_update(
+            {"_id": user_id},
+            update,
+            projection={"revision": 1},
+            upsert=upsert,
+            return_document=ReturnDocument.BEFORE,
+        )
+        return (previous or {}).get("revision"), revision
+
+    async def append(self, user_id: str, messages: List[Dict], max_messages: int) -> Tuple[Optional[str], str]:
+        return await self._update(user_id, {
+            "$push": {"messages": {"$each": messages, "$slice": -max_messages}},
+            "$setOnInsert": {"summary": ""},
+        }, upsert=True)
+
+    async def seed(self, user_id: str, messages: List[Dict], summary: str = "") -> Optional[str]:
+        revision = uuid.uuid4().hex
+        try:
+            await self.collection.insert_one({
+                "_id": user_id,
+                "messages": messages,
+                "summary": summary,
+                "revision": revision,
+                "updated_at": datetime.now(),
+            })
+        except DuplicateKeyError:
+            return None
+        return revision
+
+    async def fold(self, user_id: str, summary: str, message_ids: List[int]) -> Tuple[Optional[str], str]:
+        return await self._update(user_id, {
+            "$pull": {"messages": {"id": {"$in": message_ids}}},
+            "$set": {"summary": summary},
+        })
+
+    async def clear(self, user_id: str) -> bool:
+        previous, _ = await self._update(user_id, {"$set": {"messages": [], "summary": ""}}, upsert=True)
+        return previous is not None
+
+# Fields needed to rebuild context - photos are referenced, never loaded
+HISTORY_PROJECTION = {
+    "message": 1, "is_bot": 1, "is_template": 1, "timestamp": 1, "image_sha256": 1, "image_mime_type": 1,
+}
+
+async def load_recent_history(user_id: str, limit: int, since: datetime) -> List[Dict]:
+    """Rebuild session records (oldest first) from the ``messages`` log"""
+    from app.services.mongo_db import get_recent_messages
+    docs = await get_recent_messages(user_id, limit, since=since, projection=HISTORY_PROJECTION)
+    records: List[Dict] = []
+    for doc in reversed(docs):
+        if doc.get("is_template"):
+            # Acks, menus, help and error texts never enter a live session
+            continue
+        role = "assistant" if doc.get("is_bot") else "user"
+        content = doc.get("message") or ""
+        image_ref = doc.get("image_sha256")
+        if image_ref and not content:
+            content = "[Image uploaded for analysis]"
+        if not content:
+            continue
+        if role == "assistant" and records and records[-1]["role"] == "assistant":
+            # A long reply is logged as one document per WhatsApp chunk
+            records[-1]["content"] += "\n\n" + content
+            continue
+        records.append({
+            "id": int(str(doc["_id"]), 16) & ((1 << 62) - 1),
+            "role": role,
+            "content": content,
+            "timestamp": doc["timestamp"].timestamp(),
+            "image_ref": image_ref,
+            "image_mime_type": doc.get("image_mime_type") or "image/jpeg",
+        })
+    return records
+
+def create_session_store() -> SessionStore:
+    """Pick the session store backend from settings"""
+    backend = settings.SESSION_STORE_BACKEND
+    if backend == "memory":
+        return MemorySessionStore(settings.SESSION_STORE_MAX_SESSIONS, settings.SESSION_TIMEOUT_SECONDS)
+    if backend == "mongo":
+        return MongoSessionStore()
+    raise ValueError(f"Unknown SESSION_STORE_BACKEND: {backend}")
+
+session_store = create_session_store()
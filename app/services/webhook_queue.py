@@ -0,0 +1,163 @@
+import asyncio
+from typing import List, Optional
+from app.config import settings
+from app.models import InboundWhatsAppMessage
+from app.handlers.text_handler import handle_text_message, handle_help_message
+from app.handlers.image_handler import handle_image_message
+from app.services.job_queue import STATUS_DEAD, JobStore, create_job_store
+from app.services.dedupe import message_deduplicator
+from app.services.mongo_db import save_message
+from app.services.whatsapp_api import send_whatsapp_message
+from app.utils.helper import TransientError
+
+# Sent when a message still fails after every retry, so the farmer isn't left waiting
+FAILURE_MESSAGE = "⚠️ Technical problem hai. Thodi der baad phir se try kariye.\n(Something went wrong. Please try again later.)"
+
+# Durable job store plus a wake-up signal so idle workers react to new jobs
+# immediately instead of waiting for the next poll
+_store: Optional[JobStore] = None
+_wakeup: Optional[asyncio.Event] = None
+_stopping: Optional[asyncio.Event] = None
+_workers: List[asyncio.Task] = []
+
+async def process_inbound_message(inbound: InboundWhatsAppMessage, first_attempt: bool = True):
+    """Route an inbound WhatsApp message to the matching handler"""
+    if inbound.message and not inbound.media_url:
+        await handle_text_message(inbound)
+    elif inbound.media_url:
+        # The farmer already got the "photo received" ack on the first attempt
+        await handle_image_message(inbound, send_ack=first_attempt)
+    else:
+        await handle_help_message(inbound)
+
+async def _heartbeat(job: dict):
+    """Keep extending the job's lease while it is processed"""
+    assert _store is not None
+    while True:
+        await asyncio.sleep(settings.JOB_HEARTBEAT_INTERVAL_SECONDS)
+        try:
+            if not await _store.extend(job, settings.JOB_VISIBILITY_TIMEOUT_SECONDS):
+                print(f"[WEBHOOK_WORKER] Lost lease on job {job['id']}")
+                return
+        except Exception as e:
+            # Transient store error: try again on the next beat, before the lease runs out
+            print(f"[WEBHOOK_WORKER] Could not extend lease on job {job['id']}: {e}")
+
+async def _notify_failure(inbound: InboundWhatsAppMessage):
+    """Tell the farmer their message could not be answered (retries exhausted)"""
+    try:
+        await send_whatsapp_message(inbound.phone_number, FAILURE_MESSAGE)
+        await save_message(
+            user_id=inbound.user_id, message=FAILURE_MESSAGE, is_bot=True, crop_type="", is_template=True
+        )
+    except Exception as e:
+        print(f"[WEBHOOK_WORKER] Could not notify {inbound.user_id} of failed message: {e}")
+
+async def _run_job(worker_id: int, job: dict):
+    """Process one claimed job and settle it in the store"""
+    assert _store is not None
+    if job["attempts"] > settings.JOB_MAX_ATTEMPTS:
+        # Lease kept expiring (e.g. the process died mid-job every time)
+        await _store.fail(job, "Visibility timeout exceeded on every attempt")
+        print(f"[WEBHOOK_WORKER] Job {job['id']} dead-lettered after {job['attempts'] - 1} attempts")
+        return
+
+    try:
+        inbound = InboundWhatsAppMessage(**job["payload"])
+    except Exception as e:
+        await _store.fail(job, f"Invalid payload: {e}", retry=False)
+        print(f"[WEBHOOK_WORKER] Job {job['id']} dead-lettered, invalid payload: {e}")
+        return
+
+    heartbeat = asyncio.create_task(_heartbeat(job))
+    try:
+        try:
+            # The store never hands out two jobs of one farmer at once, so a
+            # photo and the question right after it can't run concurrently
+            await process_inbound_message(inbound, first_attempt=job["attempts"] == 1)
+        finally:
+            heartbeat.cancel()
+    except asyncio.CancelledError:
+        # Shutting down mid-job: hand it straight back for the next worker
+        await asyncio.shield(_store.release(job))
+        raise
+    except Exception as e:
+        # Only a TransientError means nothing reached the farmer or the session
+        # yet; replaying anything else would duplicate replies and model calls
+        transient = isinstance(e, TransientError)
+        status = await _store.fail(job, str(e), retry=transient)
+        print(f"[WEBHOOK_WORKER] Worker {worker_id} job {job['id']} failed ({status}) for {inbound.user_id}: {e}")
+        if status == STATUS_DEAD and transient:
+            await _notify_failure(inbound)
+        return
+    await _store.complete(job)
+
+async def _worker(worker_id: int):
+    """Claim jobs from the durable store until shutdown"""
+    assert _store is not None and _wakeup is not None and _stopping is not None
+    while not _stopping.is_set():
+        _wakeup.clear()
+        try:
+            job = await _store.claim(settings.JOB_VISIBILITY_TIMEOUT_SECONDS)
+        except Exception as e:
+            print(f"[WEBHOOK_WORKER] Worker {worker_id} could not claim job: {e}")
+            job = None
+
+        if job is None:
+            # Idle: sleep until a new job is enqueued or the poll interval passes
+            try:
+                await asyncio.wait_for(_wakeup.wait(), timeout=settings.JOB_POLL_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        try:
+            await _run_job(worker_id, job)
+        except Exception as e:
+            # A bad payload or a store error while settling must not kill the
+            # worker; an unsettled job is picked up again when its lease runs out
+            print(f"[WEBHOOK_WORKER] Worker {worker_id} could not settle job {job['id']}: {e}")
+            await asyncio.sleep(settings.JOB_POLL_INTERVAL_SECONDS)
+
+async def enqueue_inbound_message(inbound: InboundWhatsAppMessage, job_id: Optional[str] = None) -> str:
+    """Persist a message for background processing and wake a worker"""
+    if _store is None or _wakeup is None:
+        raise RuntimeError("Webhook workers are not running")
+    job_id = await _store.enqueue(inbound.model_dump(mode="json"), job_id, user_id=inbound.user_id)
+    _wakeup.set()
+    return job_id
+
+async def get_queue_stats() -> dict:
+    """Get job counts per status and live worker count"""
+    return {
+        "backend": type(_store).__name__ if _store else None,
+        "jobs": await _store.stats() if _store else {},
+        "workers": sum(1 for task in _workers if not task.done()),
+        "dedupe": message_deduplicator.get_stats(),
+    }
+
+async def start_webhook_workers():
+    """Open the job store and spawn the worker pool (resumes unfinished jobs)"""
+    global _store, _wakeup, _stopping
+    _store = create_job_store()
+    await _store.setup()
+    _wakeup = asyncio.Event()
+    _stopping = asyncio.Event()
+    for i in range(settings.WEBHOOK_WORKER_CONCURRENCY):
+        _workers.append(asyncio.create_task(_worker(i)))
+    print(f"[WEBHOOK_QUEUE] Started {len(_workers)} workers on {type(_store).__name__}")
+
+async def stop_webhook_workers():
+    """Stop claiming, let in-flight jobs finish within the grace period, release the rest"""
+    if _stopping is not None:
+        _stopping.set()
+    if _wakeup is not None:
+        _wakeup.set()
+    if _workers:
+        _, pending = await asyncio.wait(_workers, timeout=settings.WEBHOOK_SHUTDOWN_GRACE_SECONDS)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*_workers, return_exceptions=True)
+        if pending:
+            print(f"[WEBHOOK_QUEUE] Released {len(pending)} in-flight jobs on shutdown")
+    _workers.clear()
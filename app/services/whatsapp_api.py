@@ -1,4 +1,7 @@
-from twilio.rest import Client
+import asyncio
+import weakref
+from typing import List, Optional
+import httpx
 from app.config import settings
 
 # Twilio credentials (account SID and auth token)
@@ -6,11 +9,29 @@ TWILIO_ACCOUNT_SID = settings.TWILIO_ACCOUNT_SID
 TWILIO_AUTH_TOKEN = settings.TWILIO_AUTH_TOKEN
 TWILIO_PHONE_NUMBER = settings.TWILIO_PHONE_NUMBER
 
-# Twilio client setup
-client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+TWILIO_MESSAGES_URL = f"https://api.twilio.com/2010-04-01/Accounts/{TWILIO_ACCOUNT_SID}/Messages.json"
 
-# Send message function to WhatsApp using Twilio
-def send_whatsapp_message(to: str, message: str):
+class WhatsAppSendError(Exception):
+    """Twilio rejected an outbound WhatsApp message"""
+
+# Keep-alive connection pool shared by every outbound send
+http_client = httpx.AsyncClient(
+    auth=(str(TWILIO_ACCOUNT_SID), str(TWILIO_AUTH_TOKEN)),
+    limits=httpx.Limits(
+        max_connections=settings.TWILIO_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.TWILIO_MAX_CONNECTIONS,
+    ),
+    timeout=httpx.Timeout(settings.TWILIO_TIMEOUT, connect=10.0),
+)
+
+# Bounds concurrent Twilio API calls across all recipients
+_send_slots = asyncio.Semaphore(settings.TWILIO_MAX_CONCURRENT_SENDS)
+
+# One lock per recipient so a user's messages leave in order; entries vanish
+# once no send for that recipient is in progress
+_recipient_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+def _format_recipient(to: str) -> str:
     # Strip any accidental whitespace
     to = to.strip()
 
@@ -19,17 +40,83 @@ def send_whatsapp_message(to: str, message: str):
         to = to.replace("whatsapp:", "")
 
     # Final number format should be exactly: whatsapp:+91xxxxxxxxxx
-    formatted_to = f"whatsapp:{to}"
+    return f"whatsapp:{to}"
+
+def _recipient_lock(formatted_to: str) -> asyncio.Lock:
+    lock = _recipient_locks.get(formatted_to)
+    if lock is None:
+        lock = asyncio.Lock()
+        _recipient_locks[formatted_to] = lock
+    return lock
 
+async def _post_message(formatted_to: str, message: str):
     print(f"[DEBUG] Sending to: {formatted_to} | Message: {message}")  # Optional debug log
 
-    client.messages.create(
-        body=message,
-        from_=f"whatsapp:{TWILIO_PHONE_NUMBER}",
-        to=formatted_to
-    )
+    async with _send_slots:
+        response = await http_client.post(
+            TWILIO_MESSAGES_URL,
+            data={
+                "Body": message,
+                "From": f"whatsapp:{TWILIO_PHONE_NUMBER}",
+                "To": formatted_to,
+            },
+        )
+    if response.status_code >= 400:
+        raise WhatsAppSendError(f"Twilio send failed ({response.status_code}): {response.text[:300]}")
+
+# Send messages to one WhatsApp recipient back-to-back, preserving order
+async def send_whatsapp_messages(to: str, messages: List[str]):
+    formatted_to = _format_recipient(to)
+    lock = _recipient_lock(formatted_to)
+    async with lock:
+        for message in messages:
+            await _post_message(formatted_to, message)
+
+# Send message function to WhatsApp using Twilio
+async def send_whatsapp_message(to: str, message: str):
+    await send_whatsapp_messages(to, [message])
+
+class WhatsAppReplyStream:
+    """Delivers a streamed LLM reply chunk by chunk as each one completes.
+
+    ``completed`` is set once the model has finished the reply; otherwise
+    (cache hit, shared completion, model failure mid-stream) the caller sends
+    the final reply itself. Sending never raises: after a failed send the
+    remaining chunks are held in ``unsent`` for the caller to deliver, so a
+    Twilio error can't abort a completion other callers are waiting on.
+    """
+
+    def __init__(self, to: str, first_prefix: str = ""):
+        self.to = to
+        self.first_prefix = first_prefix
+        self.sent: List[str] = []
+        self.unsent: List[str] = []
+        self.error: Optional[Exception] = None
+        self.completed = False
+
+    async def send(self, chunk: str):
+        if self.error is None:
+            prefix = self.first_prefix if not self.sent else ""
+            try:
+                await send_whatsapp_message(self.to, prefix + chunk)
+                self.sent.append(chunk)
+                return
+            except Exception as e:
+                self.error = e
+                print(f"[WHATSAPP] Streaming to {self.to} failed, holding back the rest of the reply: {e}")
+        self.unsent.append(chunk)
+
+    def unsent_messages(self) -> List[str]:
+        """Held-back chunks as messages, prefixed if nothing went out yet"""
+        if self.unsent and not self.sent:
+            return [self.first_prefix + self.unsent[0]] + self.unsent[1:]
+        return list(self.unsent)
 
 # Send image analysis result to WhatsApp
-def send_image_analysis_result(to: str, result: str):
+async def send_image_analysis_result(to: str, result: str):
     message = f"The crop diagnosis is: {result}"
-    return send_whatsapp_message(to, message)
+    return await send_whatsapp_message(to, message)
+
+async def close_whatsapp_client():
+    """Close the outbound Twilio connection pool (called on app shutdown)"""
+    await http_client.aclose()
\ No newline at end of file
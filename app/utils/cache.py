@@ -0,0 +1,88 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after ``ttl`` seconds.
+
+    Tracks hit/miss/eviction counters for the debug endpoints. ``on_remove``
+    is called with (key, value) whenever a value leaves the cache (replaced,
+    evicted, expired, invalidated or cleared); it runs under the cache lock,
+    so it must not call back into the cache.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 300.0,
+                 on_remove: Optional[Callable[[Hashable, Any], None]] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_remove = on_remove
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Return the cached value (refreshing its LRU position) or ``default``"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                self._removed(key, value)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        """Insert or replace a value, evicting the least recently used beyond max_size"""
+        with self._lock:
+            previous = self._data.get(key)
+            self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._data.move_to_end(key)
+            if previous is not None:
+                self._removed(key, previous[1])
+            while len(self._data) > self.max_size:
+                evicted_key, (_, evicted) = self._data.popitem(last=False)
+                self._removed(evicted_key, evicted)
+                self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> bool:
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return False
+            self._removed(key, entry[1])
+            return True
+
+    def clear(self):
+        with self._lock:
+            entries, self._data = self._data, OrderedDict()
+            for key, (_, value) in entries.items():
+                self._removed(key, value)
+
+    def _removed(self, key: Hashable, value: Any):
+        if self.on_remove is not None:
+            self.on_remove(key, value)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
@@ -6,6 +6,9 @@ from app.config import settings
 TWILIO_ACCOUNT_SID = settings.TWILIO_ACCOUNT_SID
 TWILIO_AUTH_TOKEN = settings.TWILIO_AUTH_TOKEN
 
+class TransientError(Exception):
+    """Temporary upstream failure (timeout, 5xx, rate limit) - the job queue retries it"""
+
 # Helper functions
 def extract_phone_number(from_field: str) -> str:
     """Extract clean phone number from WhatsApp format"""
@@ -20,6 +23,18 @@ def is_hindi_english_mixed(text: str) -> bool:
 
 
 
+def detect_image_mime(data: bytes) -> str:
+    """Detect the image MIME type from its magic bytes (defaults to JPEG)"""
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return "image/png"
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return "image/webp"
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return "image/gif"
+    if data[4:12] in (b'ftypheic', b'ftypheix', b'ftypmif1', b'ftypmsf1'):
+        return "image/heic"
+    return "image/jpeg"
+
 def format_whatsapp_message(message: str, max_length: int = 1500) -> list:
     """Smart message formatting for WhatsApp with Twilio limits"""
     # Twilio's actual limit is 1600 characters, but we use 1500 for safety
@@ -92,6 +107,51 @@ def format_whatsapp_message(message: str, max_length: int = 1500) -> list:
     
     return final_chunks if final_chunks else [message[:max_length]]
 
+class WhatsAppStreamChunker:
+    """Assembles streamed LLM tokens into WhatsApp-sized chunks.
+
+    A chunk is released at the last paragraph break once at least min_length
+    characters are buffered, so farmers get whole sections as they are
+    written; anything reaching max_length is cut at the best boundary.
+    """
+
+    def __init__(self, max_length: int = 1500, min_length: int = 400):
+        self.max_length = max_length
+        self.min_length = min_length
+        self.buffer = ""
+
+    def _cut_point(self):
+        if len(self.buffer) > self.max_length:
+            window = self.buffer[:self.max_length]
+            for separator in ('\n\n', '\n', '. ', ' '):
+                index = window.rfind(separator)
+                if index > 0:
+                    return index + len(separator)
+            return self.max_length
+        index = self.buffer.rfind('\n\n')
+        if index >= self.min_length:
+            return index + 2
+        return None
+
+    def feed(self, delta: str) -> list:
+        """Add streamed text; returns the chunks completed by it"""
+        self.buffer += delta
+        chunks = []
+        cut = self._cut_point()
+        while cut is not None:
+            chunk = self.buffer[:cut].strip()
+            self.buffer = self.buffer[cut:]
+            if chunk:
+                chunks.append(chunk)
+            cut = self._cut_point()
+        return chunks
+
+    def flush(self) -> list:
+        """Return whatever is left once the stream has ended"""
+        rest = self.buffer.strip()
+        self.buffer = ""
+        return format_whatsapp_message(rest, self.max_length) if rest else []
+
 
 
 def download_twilio_media(media_url: str) -> bytes:
@@ -153,15 +213,19 @@ def download_twilio_media(media_url: str) -> bytes:
         if response.status_code == 200:
             return response.content
             
+        # Twilio-side trouble is worth another attempt later
+        if response.status_code == 429 or response.status_code >= 500:
+            raise TransientError(f"Image download failed with status {response.status_code}")
+        
         # If still failing, provide detailed error
         raise ValueError(f"Failed to download image. Status: {response.status_code}, Response: {response.text[:300]}")
         
     except requests.exceptions.Timeout:
-        raise ValueError("Image download timed out after 30 seconds")
+        raise TransientError("Image download timed out after 30 seconds")
     except requests.exceptions.ConnectionError as e:
-        raise ValueError(f"Connection error while downloading image: {str(e)}")
-    except ValueError:
-        # Re-raise ValueError as-is
+        raise TransientError(f"Connection error while downloading image: {str(e)}")
+    except (ValueError, TransientError):
+        # Re-raise as-is
         raise
     except Exception as e:
         raise ValueError(f"Unexpected error during image download: {str(e)}")
\ No newline at end of file
@@ -0,0 +1,37 @@
+import asyncio
+
+try:
+    import tiktoken
+except ImportError:  # fall back to a character-based estimate
+    tiktoken = None
+
+# Per-message framing overhead of the chat format (role, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Loaded once at startup by load_tokenizer(); until then (or if loading
+# fails) counts use the character estimate
+_encoding = None
+
+def _load_encoding():
+    global _encoding
+    if tiktoken is None or _encoding is not None:
+        return
+    try:
+        # o200k_base is the gpt-4o tokenizer; the first load downloads its BPE file
+        _encoding = tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        print(f"[TOKENS] Could not load tiktoken encoding, using character estimate: {e}")
+
+async def load_tokenizer():
+    """Load the tokenizer off the event loop (called once on startup)"""
+    await asyncio.to_thread(_load_encoding)
+
+def count_tokens(text: str) -> int:
+    """Count prompt tokens for a piece of text"""
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    # Devanagari packs fewer characters per token than Latin text
+    devanagari = sum(1 for ch in text if 'ऀ' <= ch <= 'ॿ')
+    return (len(text) - devanagari) // 4 + devanagari // 2 + 1
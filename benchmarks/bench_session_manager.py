@@ -0,0 +1,101 @@
+"""Session manager lock contention benchmark.
+
+Runs N threads, each acting for its own set of users (create the session,
+add a message, read the context back, read the session info), against a
+single-lock manager (1 shard) and the striped manager. Each operation is
+followed by --think-ms of blocking wait, standing in for the store, LLM and
+Twilio calls a turn makes outside the session locks. A maintenance thread
+meanwhile runs the expiry pass and the /sessions/stats scan in a loop over
+--preload resident sessions.
+
+Reports throughput, speedup over one thread, and how often a thread had to
+wait for any manager lock. On a GIL build the CPU-bound part can't run in
+parallel, so speedup comes from overlapping the waits. It stays close to
+linear as long as threads don't queue on locks, and the contention columns
+show how much the shards cut those lock waits.
+
+    python -m benchmarks.bench_session_manager --threads 1 2 4 8 16 --ops 500
+"""
+import argparse
+import contextlib
+import io
+import threading
+import time
+
+from app.services.session_manager import MessageType, SessionManager
+
+def run(num_shards: int, num_threads: int, ops_per_thread: int, users_per_thread: int,
+        think_seconds: float, preload: int) -> dict:
+    manager = SessionManager(num_shards=num_shards, cleanup_interval=3600)
+    for i in range(preload):
+        manager.add_message(f"+92{i:010d}", "Namaste", MessageType.USER)
+    barrier = threading.Barrier(num_threads + 1)
+    stopping = threading.Event()
+
+    def maintenance():
+        # What the cleanup task and the stats endpoint do in production
+        while not stopping.is_set():
+            manager.expire_sessions()
+            manager.get_all_sessions_info()
+
+    def worker(worker_id: int):
+        users = [f"+91{worker_id:04d}{i:06d}" for i in range(users_per_thread)]
+        barrier.wait()
+        for i in range(ops_per_thread):
+            user_id = users[i % users_per_thread]
+            if i % 4 == 0:
+                manager.add_message(user_id, "Gehu ki patti peeli ho rahi hai", MessageType.USER)
+            elif i % 4 == 1:
+                manager.get_conversation_context(user_id, "system", "chat")
+            elif i % 4 == 2:
+                manager.get_session_info(user_id)
+            else:
+                # Churn: a new user's first message takes the create path
+                manager.get_or_create_session(f"{user_id}-{i}")
+            if think_seconds:
+                time.sleep(think_seconds)
+
+    threads = [threading.Thread(target=worker, args=(t,)) for t in range(num_threads)]
+    maintainer = threading.Thread(target=maintenance)
+    for thread in threads:
+        thread.start()
+    maintainer.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    stopping.set()
+    maintainer.join()
+
+    return {
+        "ops_per_sec": num_threads * ops_per_thread / elapsed,
+        **manager.get_lock_stats(),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 16])
+    parser.add_argument("--ops", type=int, default=500, help="operations per thread")
+    parser.add_argument("--users", type=int, default=50, help="distinct users per thread")
+    parser.add_argument("--think-ms", type=float, default=2.0, help="blocking wait after each operation")
+    parser.add_argument("--preload", type=int, default=5000, help="resident sessions scanned by maintenance")
+    args = parser.parse_args()
+
+    print(f"{'shards':>6} {'threads':>7} {'ops/s':>10} {'speedup':>8} {'contended':>10} {'rate':>7} {'wait ms':>9}")
+    for num_shards in args.shards:
+        baseline = None
+        for num_threads in args.threads:
+            # The manager logs every message; keep the table readable
+            with contextlib.redirect_stdout(io.StringIO()):
+                result = run(num_shards, num_threads, args.ops, args.users, args.think_ms / 1000, args.preload)
+            baseline = baseline or result["ops_per_sec"] / num_threads
+            print(
+                f"{num_shards:>6} {num_threads:>7} {result['ops_per_sec']:>10.0f} "
+                f"{result['ops_per_sec'] / baseline:>7.1f}x "
+                f"{result['contended']:>10} {result['contention_rate']:>7.2%} {result['wait_ms']:>9.1f}"
+            )
+
+if __name__ == "__main__":
+    main()
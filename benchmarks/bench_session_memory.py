@@ -0,0 +1,175 @@
+"""Session memory benchmark.
+
+Measures traced bytes before (the baseline Message: a plain dataclass with a
+datetime timestamp, rendered to a throwaway dict on every context build) and
+after (the slotted Message with a float timestamp, store id and cached token
+count, plus the session's render cache):
+
+- a full text-only session, resident
+- a full session where every tenth message is a photo, resident (the
+  baseline keeps every payload; now only the current turn does)
+- what one context build allocates on a full session
+- a single message record, with and without its text
+
+    python -m benchmarks.bench_session_memory --sessions 2000 --messages 30
+"""
+import argparse
+import contextlib
+import gc
+import io
+import threading
+import tracemalloc
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+
+from app.services.session_manager import ConversationSession, Message, MessageType
+
+USER_TEXT = "Mere gehu ki pattiyon par peele dhabbe aa rahe hain, kya karun? ({})"
+BOT_TEXT = "🌾 फ़सल (Crop): गेहूं (Wheat)\n🔍 समस्या (Problem): पीला रतुआ (Yellow Rust)\n" * 4 + "({})"
+
+@dataclass
+class BaselineMessage:
+    """Message as it was before slots (per-instance __dict__, datetime)"""
+    content: str
+    message_type: MessageType
+    timestamp: datetime
+    image_base64: Optional[str] = None
+
+class BaselineSession:
+    """Session state as it was before (no tokens, summary or store sync)"""
+
+    def __init__(self, user_id: str, max_messages: int = 30, session_timeout: int = 3600):
+        self.user_id = user_id
+        self.messages = []
+        self.max_messages = max_messages
+        self.session_timeout = session_timeout
+        self.last_activity = datetime.now()
+        self.created_at = datetime.now()
+        self._lock = threading.Lock()
+
+def baseline_render(session: BaselineSession) -> list:
+    # What the baseline get_messages_for_ai built on every call (text messages)
+    return [{"role": m.message_type.value, "content": m.content} for m in session.messages]
+
+def text(i: int) -> str:
+    # Fresh string per message, as with real traffic
+    return (USER_TEXT if i % 2 == 0 else BOT_TEXT).format(i)
+
+def message_type(i: int) -> MessageType:
+    return MessageType.USER if i % 2 == 0 else MessageType.ASSISTANT
+
+def photo(size: int, seed: int) -> str:
+    # Distinct base64-sized payload per photo
+    return f"{seed:08d}".ljust(size, "A")
+
+def is_photo(i: int) -> bool:
+    return i % 10 == 0
+
+def measure(build) -> int:
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = build()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objects
+    return after - before
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=2000)
+    parser.add_argument("--messages", type=int, default=30)
+    parser.add_argument("--photo-sessions", type=int, default=50)
+    parser.add_argument("--photo-kb", type=int, default=200, help="base64 size of each photo")
+    args = parser.parse_args()
+    count = args.sessions * args.messages
+    photo_size = args.photo_kb * 1024
+
+    def build_baseline_sessions():
+        sessions = []
+        for s in range(args.sessions):
+            session = BaselineSession(f"+91{s:010d}", max_messages=args.messages)
+            for i in range(args.messages):
+                session.messages.append(BaselineMessage(text(i), message_type(i), datetime.now()))
+            sessions.append(session)
+        return sessions
+
+    def build_sessions():
+        sessions = []
+        for s in range(args.sessions):
+            session = ConversationSession(f"+91{s:010d}", max_messages=args.messages, max_tokens=10**9)
+            for i in range(args.messages):
+                session.add_message(text(i), message_type(i))
+            session.get_messages_for_ai()
+            sessions.append(session)
+        return sessions
+
+    def build_baseline_photo_sessions():
+        sessions = []
+        for s in range(args.photo_sessions):
+            session = BaselineSession(f"+91{s:010d}", max_messages=args.messages)
+            for i in range(args.messages):
+                image = photo(photo_size, s * args.messages + i) if is_photo(i) else None
+                session.messages.append(BaselineMessage(text(i), message_type(i), datetime.now(), image))
+            sessions.append(session)
+        return sessions
+
+    def build_photo_sessions():
+        sessions = []
+        for s in range(args.photo_sessions):
+            session = ConversationSession(f"+91{s:010d}", max_messages=args.messages, max_tokens=10**9)
+            for i in range(args.messages):
+                if is_photo(i):
+                    session.add_message(
+                        text(i), MessageType.USER, photo(photo_size, s * args.messages + i), f"{i:064x}"
+                    )
+                else:
+                    session.add_message(text(i), message_type(i))
+            sessions.append(session)
+        return sessions
+
+    def build_text():
+        # The message text itself, identical in both layouts
+        return [text(i) for i in range(count)]
+
+    def build_baseline_messages():
+        return [BaselineMessage(text(i), message_type(i), datetime.now()) for i in range(count)]
+
+    def build_messages():
+        return [Message(text(i), message_type(i)) for i in range(count)]
+
+    baseline_session_bytes = measure(build_baseline_sessions)
+    # The manager logs every message; keep the table readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        session_bytes = measure(build_sessions)
+    baseline_photo_bytes = measure(build_baseline_photo_sessions)
+    photo_bytes = measure(build_photo_sessions)
+
+    # Context builds: keep every result alive so its allocations are counted
+    baseline_sessions = build_baseline_sessions()
+    with contextlib.redirect_stdout(io.StringIO()):
+        sessions = build_sessions()
+    baseline_render_bytes = measure(lambda: [baseline_render(session) for session in baseline_sessions])
+    render_bytes = measure(lambda: [session.get_messages_for_ai() for session in sessions])
+    del baseline_sessions, sessions
+
+    text_bytes = measure(build_text)
+    baseline_bytes = measure(build_baseline_messages)
+    message_bytes = measure(build_messages)
+
+    print(f"sessions: {args.sessions} x {args.messages} messages")
+    print(f"{'':24} {'before':>10} {'after':>10} {'change':>8}")
+    rows = [
+        ("bytes/session", baseline_session_bytes / args.sessions, session_bytes / args.sessions),
+        ("bytes/photo session", baseline_photo_bytes / args.photo_sessions, photo_bytes / args.photo_sessions),
+        ("bytes/context build", baseline_render_bytes / args.sessions, render_bytes / args.sessions),
+        ("bytes/message", baseline_bytes / count, message_bytes / count),
+        ("overhead/message", (baseline_bytes - text_bytes) / count, (message_bytes - text_bytes) / count),
+    ]
+    for label, before, after in rows:
+        print(f"{label:24} {before:>10.0f} {after:>10.0f} {(after - before) / before:>+8.1%}")
+
+if __name__ == "__main__":
+    main()